@@ -0,0 +1,286 @@
+"""
+Performance benchmarks for templatemail's render and delivery paths.
+
+Run from the repository root:
+
+    python -m benchmarks.run                          # Print a table
+    python -m benchmarks.run --json results.json      # Also save machine-readable results
+    python -m benchmarks.run --compare baseline.json  # Compare against earlier results
+
+Engines are benchmarked against in-process stand-ins: a minimal SMTP server and a fake Mailgun HTTP API, both
+listening on localhost, so results measure templatemail itself rather than a network.
+"""
+import argparse
+import json
+import os
+import platform
+import socketserver
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import templatemail
+import templatemail.engines.mailgun
+import templatemail.engines.smtp
+
+TEMPLATE_CONTEXTS = {
+    'mailgun-transactional/action.html': dict(
+        subject="Did You Forget Your Password?",
+        meta_name='Confirm Email',
+        leadin='Please confirm your email address by clicking the link below.',
+        explanation='We may need to send you critical information about our service.',
+        action_link='https://localhost:8080/forgot-password/click-me',
+        action_text="Reset your password",
+        signature='--The Team',
+        footer='You are getting this message because someone clicked on Forgot Password on our site.'
+    ),
+    'mailgun-transactional/alert.html': dict(
+        subject='You are over the number of widgets',
+        signature='--The Team',
+        action_link="http://localhost:8080/upgrade",
+        action_text="Upgrade Now",
+        warning_text="You are over the number of widgets on your current plan",
+        details="Upgrade now and you can get way, way more widgets.\nNo I'm serious, like, a ton more.",
+        footer='Sent by the Acme Corporation'
+    ),
+    'mailgun-transactional/billing.html': dict(
+        invoice_to="Lee Munroe\nInvoice #12345\nJune 01 2014",
+        services=[('Consulting', '$55'), ('Cheese Making', '$500')],
+        total_text='Total',
+        total_price='$555',
+        view_link='http://localhost:8080/invoice',
+        view_text='View your invoice online',
+        subject="Your invoice is paid",
+        title="$33.98 Paid",
+        subtitle='Thank you for using Acme.',
+        signature='--The Team',
+        footer='Sent by the Acme Corporation'
+    ),
+}
+SEND_TEMPLATE = 'mailgun-transactional/alert.html'
+
+# Statements timed in a fresh interpreter, for the cost templatemail adds to the cold start of a process.
+COLD_START_STATEMENTS = {
+    'import[templatemail]': 'import templatemail',
+    'import[templatemail.engines]': 'import templatemail.engines.smtp, templatemail.engines.mailgun',
+    'cold_start[TemplateMail()]': 'import templatemail; templatemail.TemplateMail()',
+}
+_repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept and discard messages.
+    """
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.wfile.write(b'220 localhost ESMTP\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-localhost\r\n250 8BITMIME\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                self.wfile.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class _FakeMailgunHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"id": "<benchmark@localhost>", "message": "Queued. Thank you."}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def measure(name, func, iterations, warmup=10):
+    """
+    Runs func repeatedly, returning throughput and latency percentiles, and the peak memory allocated by one call.
+    """
+    for _ in range(warmup):
+        func()
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(min(iterations, 20)):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'name': name,
+        'iterations': iterations,
+        'ops_per_sec': iterations / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'peak_alloc_kib': statistics.median(peaks) / 1024,
+    }
+
+
+def measure_cold_start(name, statement, runs):
+    """
+    Runs statement once in each of runs fresh interpreters, returning the same figures as measure. Interpreter
+    startup is not included.
+    """
+    def run(traced):
+        script = (f'import time, tracemalloc\n'
+                  f'{"tracemalloc.start()" if traced else ""}\n'
+                  f'started = time.perf_counter()\n'
+                  f'{statement}\n'
+                  f'print(time.perf_counter() - started, tracemalloc.get_traced_memory()[1])\n')
+        output = subprocess.run([sys.executable, '-c', script], cwd=_repository_root, capture_output=True, text=True,
+                                check=True).stdout
+        elapsed, peak = output.split()
+        return float(elapsed), int(peak)
+
+    latencies = [run(traced=False)[0] for _ in range(runs)]
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'name': name,
+        'iterations': runs,
+        'ops_per_sec': runs / sum(latencies),
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'peak_alloc_kib': run(traced=True)[1] / 1024,
+    }
+
+
+def run_benchmarks(iterations):
+    results = []
+    for name, statement in COLD_START_STATEMENTS.items():
+        results.append(measure_cold_start(name, statement, min(iterations, 20)))
+
+    mailer = templatemail.TemplateMail()
+
+    for template_name, context in TEMPLATE_CONTEXTS.items():
+        results.append(measure(f'render[{template_name}]',
+                               lambda: mailer.render(template_name, **context), iterations))
+
+    send_context = TEMPLATE_CONTEXTS[SEND_TEMPLATE]
+    results.append(measure('send_email[dry_run]', lambda: mailer.send_email(
+        from_address='from@example.com', to_addresses=['to@example.com'], template_name=SEND_TEMPLATE,
+        dry_run=True, **send_context), iterations))
+
+    rendered = mailer.render(SEND_TEMPLATE, **send_context)
+    message = dict(from_address='from@example.com', to_addresses=['to@example.com'], subject=rendered.subject,
+                   text_body=rendered.text_body, html_body=rendered.html_body)
+
+    smtp_server = _serve(socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPSinkHandler))
+    mailgun_server = _serve(ThreadingHTTPServer(('127.0.0.1', 0), _FakeMailgunHandler))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for pool_size in (0, 1):
+                smtp_engine = templatemail.engines.smtp.SMTPDeliveryEngine(
+                    host='127.0.0.1', port=smtp_server.server_address[1],
+                    security=templatemail.engines.smtp.SMTPSecurity.NONE, pool_size=pool_size)
+                results.append(measure(f'smtp.send_simple_message[pool_size={pool_size}]',
+                                       lambda: smtp_engine.send_simple_message(**message), iterations))
+                smtp_engine.close()
+
+        mailgun_engine = templatemail.engines.mailgun.MailgunDeliveryEngine(
+            api_key='benchmark', domain_name='example.com',
+            base_url=f'http://127.0.0.1:{mailgun_server.server_address[1]}/v3')
+        results.append(measure('mailgun.send_simple_message',
+                               lambda: mailgun_engine.send_simple_message(**message), iterations))
+        mailgun_engine.close()
+    finally:
+        smtp_server.shutdown()
+        mailgun_server.shutdown()
+
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline = {result['name']: result for result in (baseline or {}).get('results', [])}
+    print(f"{'benchmark':<56} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>9}" +
+          (f" {'vs base':>8}" if baseline else ''))
+    for result in results:
+        line = (f"{result['name']:<56} {result['ops_per_sec']:>10.1f} {result['p50_ms']:>9.3f} "
+                f"{result['p99_ms']:>9.3f} {result['peak_alloc_kib']:>9.1f}")
+        if result['name'] in baseline:
+            line += f" {result['ops_per_sec'] / baseline[result['name']]['ops_per_sec']:>7.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=500, help='Timed calls per benchmark')
+    parser.add_argument('--json', dest='json_path', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results from an earlier run to compare throughput against')
+    args = parser.parse_args(argv)
+    if args.iterations < 2:
+        parser.error('--iterations must be at least 2, to compute latency percentiles')
+
+    results = run_benchmarks(args.iterations)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'revision': _git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,32 @@
 """
 Template-based email system for Python.
 """
+import copy
+import functools
 import logging
 import os
-from collections import namedtuple
-from typing import List
+import operator
+import threading
+import warnings
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import compress, count, repeat
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, Iterator, List, Sequence, Tuple
 
-import jinja2
+from .delivery_queue import DeliveryQueue
+from .engines import AsyncEngine
+from .metrics import MetricsSink, StatsdMetricsSink, timed
+from .render_cache import RenderCache, RenderCacheStats
+
+if TYPE_CHECKING:
+    import jinja2
 
 RenderedResult = namedtuple('RenderedResult', ('subject', 'text_body', 'html_body'))
+SendResult = namedtuple('SendResult', ('to_addresses', 'delivered', 'error'))
+ValidationFailure = namedtuple('ValidationFailure', ('index', 'missing'))
 _dir_path = os.path.dirname(os.path.realpath(__file__))
 _included_template_dir = os.path.join(_dir_path, 'templates')
+_rendered_blocks = RenderedResult._fields
 
 
 class DeliveryEngineNotInstalled(Exception):
@@ -29,32 +45,500 @@ class DeliveryNotMade(Exception):
 
 
 class TemplateMail:
-    def __init__(self, template_dirs: List[str] = None, delivery_engine=None, logger=None):
+    def __init__(self, template_dirs: List[str] = None, delivery_engine=None, logger=None,
+                 delivery_queue: DeliveryQueue = None, bytecode_cache_dir: str = None, render_cache: RenderCache = None,
+                 metrics: MetricsSink = None, tenant_template_root: str = None, max_tenants: int = 256,
+                 auto_reload: bool = True, compiled_template_cache_size: int = 1024):
         """
         :param template_dirs: Directories containing templates.
+        :param delivery_queue: DeliveryQueue to hand rendered emails to. When set, send_email returns a Future as soon
+            as the email is rendered, and the email is delivered in the background.
+        :param bytecode_cache_dir: Directory in which to cache compiled templates, so they are not recompiled by
+            every new process. See warm_up.
+        :param render_cache: RenderCache in which to keep rendered email, for templates rendered repeatedly with the
+            same context.
+        :param metrics: MetricsSink to record rendering and delivery timings to. Pass the same sink to the delivery
+            engine to also record its connection and transfer timings.
+        :param tenant_template_root: Directory containing a template directory per tenant, named after the tenant.
+            See for_tenant.
+        :param max_tenants: Maximum number of tenants to keep template environments for. The least recently used
+            tenant's environment is discarded beyond this.
+        :param auto_reload: Check whether a template has changed on disk, and recompile it if so, every time it is
+            used. When False, templates are not checked on each render; call reload, or start_reloading, to pick up
+            changes instead.
+        :param compiled_template_cache_size: Maximum number of compiled templates kept in memory for tenants and
+            reloads to share. The least recently used are evicted beyond this.
         """
         _template_dirs = [_included_template_dir] + template_dirs if template_dirs else [_included_template_dir]
-        for path in _template_dirs:
-            assert os.path.exists(path)
-            assert os.path.isdir(path)
 
-        self.template_environment = jinja2.Environment(
-            undefined=jinja2.StrictUndefined,
-            loader=jinja2.FileSystemLoader(_template_dirs)
-        )
+        self.template_dirs = template_dirs
+        self.bytecode_cache_dir = bytecode_cache_dir
+        self.tenant_template_root = tenant_template_root
+        self.max_tenants = max_tenants
+        self.tenant = None
+        self.auto_reload = auto_reload
+        self.compiled_template_cache_size = compiled_template_cache_size
+        self._template_search_path = _template_dirs
+        self._bytecode_cache = None
+        self._tenants = OrderedDict()
+        self._shared_mailer = None
+        self._reloader = None
+        self._stop_reloading = threading.Event()
+        self._tenants_lock = threading.Lock()
+
+        # The template environment is built on first use, so that a TemplateMail which is created but never used,
+        # eg. in a short-lived CLI command, does not pay for importing and configuring Jinja.
+        self._template_environment = None
+        self._async_template_environment = None
+        self._environment_lock = threading.Lock()
+        self.render_cache = render_cache
 
         self.delivery_engine = delivery_engine
+        self.delivery_queue = delivery_queue
+        self.metrics = metrics
 
         self.logger = logger or logging.getLogger('templatemail')
 
+    @property
+    def template_environment(self) -> 'jinja2.Environment':
+        environment = self._template_environment
+        if environment is None:
+            with self._environment_lock:
+                if self._template_environment is None:
+                    self._template_environment = self._new_template_environment(self._template_search_path)
+                environment = self._template_environment
+        return environment
+
+    @template_environment.setter
+    def template_environment(self, environment: 'jinja2.Environment'):
+        self._template_environment = environment
+
+    def for_tenant(self, tenant: str) -> 'TemplateMail':
+        """
+        Returns a TemplateMail which renders with the templates in tenant's directory under tenant_template_root,
+        falling back to the shared template directories for templates the tenant does not override. It shares this
+        TemplateMail's delivery engine, delivery queue, render cache and metrics.
+
+        Compiled templates are shared between all tenants, so a shared template is only compiled once, however many
+        tenants use it. Tenants' template environments are kept for reuse, up to max_tenants of them. A tenant with
+        no template directory uses the shared templates; a directory created for a tenant is picked up once its
+        environment is discarded.
+
+        :param tenant: Name of the tenant's template directory
+        :return: TemplateMail for the tenant
+        """
+        if not self.tenant_template_root:
+            raise ValueError('TemplateMail was created without a tenant_template_root')
+        if self._shared_mailer is not None:
+            return self._shared_mailer.for_tenant(tenant)
+
+        with self._tenants_lock:
+            mailer = self._tenants.get(tenant)
+            if mailer is not None:
+                self._tenants.move_to_end(tenant)
+                return mailer
+
+        from .tenants import tenant_template_dir
+
+        template_dir = tenant_template_dir(self.tenant_template_root, tenant)
+        if os.path.isdir(template_dir):
+            mailer = copy.copy(self)
+            mailer.tenant = tenant
+            mailer._shared_mailer = self
+            # The copy shares the configuration, engine and caches, but not the shared mailer's own state.
+            mailer._tenants = OrderedDict()
+            mailer._tenants_lock = threading.Lock()
+            mailer._reloader = None
+            mailer._stop_reloading = threading.Event()
+            mailer._environment_lock = threading.Lock()
+            mailer.template_environment = mailer._new_template_environment([template_dir] + self._template_search_path)
+            mailer._async_template_environment = None
+        else:
+            mailer = self
+
+        with self._tenants_lock:
+            mailer = self._tenants.setdefault(tenant, mailer)
+            self._tenants.move_to_end(tenant)
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+        return mailer
+
+    def reload(self) -> List[str]:
+        """
+        Checks every template loaded so far for changes on disk. If any have changed, a new template environment is
+        built, the loaded templates are compiled into it, and it replaces the current one. Renders already under way
+        finish with the templates they started with. If a changed template fails to compile, the error is raised and
+        the current templates stay in use. Tenants' templates are reloaded too.
+
+        :return: Names of the changed templates
+        """
+        if self._shared_mailer is not None:
+            return self._shared_mailer.reload()
+
+        with self._tenants_lock:
+            mailers = [self] + [mailer for mailer in self._tenants.values() if mailer is not self]
+        changed_template_names = []
+        for mailer in mailers:
+            changed_template_names.extend(mailer._reload_template_environment())
+        return changed_template_names
+
+    def start_reloading(self, interval: float = 1.0):
+        """
+        Starts a background thread which calls reload every interval seconds, so template changes are picked up
+        without auto_reload checking templates on every render. Failed reloads are logged.
+        """
+        if self._reloader is not None:
+            return
+        self._stop_reloading.clear()
+        self._reloader = threading.Thread(target=self._reload_periodically, args=(interval,),
+                                          name='templatemail-reloader', daemon=True)
+        self._reloader.start()
+
+    def stop_reloading(self):
+        """
+        Stops the thread started by start_reloading.
+        """
+        if self._reloader is None:
+            return
+        self._stop_reloading.set()
+        self._reloader.join()
+        self._reloader = None
+
     def render(self, template_name: str, *args, **kwargs) -> RenderedResult:
-        content = self._render_partial(template_name, 'subject', *args, **kwargs)
-        text_body = self._render_partial(template_name, 'text_body', *args, **kwargs)
-        html_body = self._render_partial(template_name, 'html_body', *args, **kwargs)
+        """
+        Renders the subject, text body and html body of a template in a single pass over its inheritance chain.
 
-        return RenderedResult(content, text_body, html_body)
+        :param template_name: Name of the template to render
+        :return: RenderedResult of the stripped subject, text body and html body
+        """
+        cache_key = self._render_cache_key(template_name, args, kwargs)
+        if cache_key is not None:
+            cached = self.render_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        environment = self.template_environment
+        with timed(self.metrics, 'render', {'template': template_name}):
+            render_template, context, rendered_blocks = self._new_render_context(
+                environment, template_name, args, kwargs)
+            try:
+                environment.concat(render_template.root_render_func(context))
+                for block in _rendered_blocks:
+                    if block not in rendered_blocks:
+                        environment.concat(context.blocks[block][0](context))
+            except Exception:
+                environment.handle_exception()
+
+        rendered_email = RenderedResult(*(rendered_blocks[block].strip() for block in _rendered_blocks))
+        if cache_key is not None:
+            self.render_cache.set(cache_key, rendered_email)
+        return rendered_email
+
+    async def render_async(self, template_name: str, *args, **kwargs) -> RenderedResult:
+        """
+        Renders a template like render, but as a coroutine, using an async-enabled copy of the template environment.
+        Templates may then await async functions and iterate async iterables passed in their context.
+
+        :param template_name: Name of the template to render
+        :return: RenderedResult of the stripped subject, text body and html body
+        """
+        cache_key = self._render_cache_key(template_name, args, kwargs)
+        if cache_key is not None:
+            cached = self.render_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        environment = self._get_async_template_environment()
+        with timed(self.metrics, 'render', {'template': template_name}):
+            render_template, context, rendered_blocks = self._new_render_context(
+                environment, template_name, args, kwargs)
+            try:
+                [_ async for _ in render_template.root_render_func(context)]
+                for block in _rendered_blocks:
+                    if block not in rendered_blocks:
+                        [_ async for _ in context.blocks[block][0](context)]
+            except Exception:
+                environment.handle_exception()
+
+        rendered_email = RenderedResult(*(rendered_blocks[block].strip() for block in _rendered_blocks))
+        if cache_key is not None:
+            self.render_cache.set(cache_key, rendered_email)
+        return rendered_email
+
+    def required_variables(self, template_name: str) -> FrozenSet[str]:
+        """
+        Finds the context variables a template needs to render, without rendering it, by analysing the template,
+        the templates it extends and includes, the blocks that are rendered and the macros they call. Variables whose
+        every use is guarded by the defined test or the default filter are not required.
+
+        :param template_name: Name of the template
+        :return: Names of the required variables
+        """
+        from .validation import required_variables
+
+        return required_variables(self.template_environment, template_name, _rendered_blocks)
+
+    def validate(self, template_name: str, contexts: Iterable[Dict],
+                 none_is_missing: bool = False) -> List[ValidationFailure]:
+        """
+        Checks that each context has every variable template_name requires, without rendering it. This catches the
+        undefined variable errors a render would raise, at the cost of a set comparison per context.
+
+        :param template_name: Name of the template
+        :param contexts: Iterable of template contexts
+        :param none_is_missing: Also count a variable as missing if it is None. None renders without error, but is
+            often a sign of missing data.
+        :return: A ValidationFailure, of the context's index and the missing variable names, for each context which
+            lacks a required variable
+        """
+        required = self.required_variables(template_name)
+        if not none_is_missing:
+            return [ValidationFailure(index, frozenset(required - context.keys()))
+                    for index, context in enumerate(contexts) if not context.keys() >= required]
+
+        failures = []
+        for index, context in enumerate(contexts):
+            missing = frozenset(name for name in required if context.get(name) is None)
+            if missing:
+                failures.append(ValidationFailure(index, missing))
+        return failures
+
+    def validate_columns(self, template_name: str, columns: Dict[str, Sequence],
+                         none_is_missing: bool = False) -> List[ValidationFailure]:
+        """
+        Checks contexts given as columns, eg. read from a CSV file, against the variables template_name requires,
+        without rendering it. Rather than checking row by row, each required column is checked in one pass, and
+        columns with no missing values are skipped at once. A value is missing from a row if its column is absent.
+
+        :param template_name: Name of the template
+        :param columns: Mapping of variable names to sequences of values, one per row. Every column must be the same
+            length.
+        :param none_is_missing: Also count a value as missing if it is None, eg. for a blank cell.
+        :return: A ValidationFailure, of the row's index and the missing variable names, for each row which lacks a
+            required variable
+        """
+        lengths = {len(column) for column in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError('Every column must be the same length')
+        row_count = lengths.pop() if lengths else 0
+
+        required = self.required_variables(template_name)
+        missing_columns = frozenset(name for name in required if name not in columns)
+        missing_by_row = defaultdict(set)
+        for name in required - missing_columns if none_is_missing else ():
+            column = columns[name]
+            if None in column:
+                for index in compress(count(), map(operator.is_, column, repeat(None))):
+                    missing_by_row[index].add(name)
+
+        if missing_columns:
+            return [ValidationFailure(index, missing_columns | missing_by_row.get(index, frozenset()))
+                    for index in range(row_count)]
+        return [ValidationFailure(index, frozenset(missing_by_row[index])) for index in sorted(missing_by_row)]
+
+    def render_many(self, template_name: str, contexts: Iterable[Dict], processes: int = None,
+                    chunk_size: int = 100) -> Iterator[RenderedResult]:
+        """
+        Renders one template with many contexts, across a pool of worker processes, so that rendering is not limited
+        to one CPU core. Each worker builds its own TemplateMail from the same template directories. Contexts are
+        consumed lazily and sent to the workers in chunks, and renderings are yielded in the order of the contexts.
+
+        Contexts must be picklable. The render cache and metrics of this TemplateMail are not used by the workers.
+
+        :param template_name: Name of the template to render
+        :param contexts: Iterable of template contexts
+        :param processes: Number of worker processes. Defaults to the number of CPUs.
+        :param chunk_size: Number of contexts sent to a worker at a time
+        :return: Iterator of RenderedResult, one per context
+        """
+        from .bulk_render import render_in_processes
+
+        for _, rendered_email in render_in_processes(self._worker_factory(), self._worker_kwargs(), template_name,
+                                                     ((None, context) for context in contexts),
+                                                     processes=processes, chunk_size=chunk_size):
+            yield rendered_email
+
+    def _worker_factory(self):
+        if self.tenant is None:
+            return type(self)
+        from .tenants import tenant_mailer
+
+        return functools.partial(tenant_mailer, type(self), self.tenant)
+
+    def _worker_kwargs(self) -> Dict:
+        # Every option which affects rendering, so workers render exactly as this TemplateMail does.
+        return dict(template_dirs=self.template_dirs, bytecode_cache_dir=self.bytecode_cache_dir,
+                    tenant_template_root=self.tenant_template_root, max_tenants=self.max_tenants,
+                    auto_reload=self.auto_reload, compiled_template_cache_size=self.compiled_template_cache_size)
+
+    def _render_cache_key(self, template_name: str, args, kwargs):
+        if self.render_cache is None:
+            return None
+        return self.render_cache.key(self.template_environment, template_name, dict(*args, **kwargs),
+                                     namespace=self.tenant)
+
+    def warm_up(self, extensions: List[str] = None) -> List[str]:
+        """
+        Compiles every template in the template directories ahead of time, so that the first render of each one
+        does not pay for parsing and compiling it. With a bytecode_cache_dir, the compiled templates are also written
+        to the cache for other processes to use.
+
+        :param extensions: Only compile templates with these file extensions, eg. ['html']. Defaults to all files.
+        :return: Names of the compiled templates
+        """
+        template_names = self.template_environment.list_templates(extensions=extensions)
+        for template_name in template_names:
+            self.template_environment.get_template(template_name)
+        return template_names
+
+    def _new_template_environment(self, search_path: List[str]) -> 'jinja2.Environment':
+        import jinja2
+        from .static_includes import StaticIncludeExtension, StaticIncludeLoader
+
+        return jinja2.Environment(
+            undefined=jinja2.StrictUndefined,
+            loader=StaticIncludeLoader(search_path),
+            bytecode_cache=self._get_bytecode_cache(),
+            extensions=[StaticIncludeExtension],
+            auto_reload=self.auto_reload
+        )
+
+    def _get_bytecode_cache(self):
+        if self._shared_mailer is not None:
+            return self._shared_mailer._get_bytecode_cache()
+        if self._bytecode_cache is None and (self.bytecode_cache_dir or self.tenant_template_root or
+                                             not self.auto_reload):
+            import jinja2
+            from .static_includes import StaticIncludeBytecodeCache
+            from .tenants import SharedBytecodeCache
+
+            if self.tenant_template_root or not self.auto_reload:
+                # Tenant environments share compiled templates with this one, and with each other, and reloaded
+                # environments reuse the compiled templates which have not changed.
+                self._bytecode_cache = SharedBytecodeCache(
+                    jinja2.FileSystemBytecodeCache(self.bytecode_cache_dir) if self.bytecode_cache_dir else None,
+                    max_size=self.compiled_template_cache_size)
+            else:
+                self._bytecode_cache = StaticIncludeBytecodeCache(self.bytecode_cache_dir)
+        return self._bytecode_cache
+
+    def _reload_template_environment(self) -> List[str]:
+        import jinja2
+
+        environment = self.template_environment
+        templates = list(environment.cache.values()) if environment.cache is not None else []
+        changed_template_names = [template.name for template in templates if not template.is_up_to_date]
+        if not changed_template_names:
+            return []
+
+        new_environment = self._new_template_environment(environment.loader.searchpath)
+        for template in templates:
+            try:
+                new_environment.get_template(template.name)
+            except jinja2.TemplateNotFound:
+                pass
+        self.template_environment = new_environment
+        self._async_template_environment = None
+        self.logger.info(f'Reloaded templates: {", ".join(changed_template_names)}')
+        return changed_template_names
+
+    def _reload_periodically(self, interval: float):
+        while not self._stop_reloading.wait(interval):
+            try:
+                self.reload()
+            except Exception:
+                self.logger.exception('Failed to reload templates')
+
+    def _get_async_template_environment(self) -> 'jinja2.Environment':
+        import jinja2
+        from .static_includes import StaticIncludeExtension
+
+        if self._async_template_environment is None:
+            self._async_template_environment = jinja2.Environment(
+                undefined=self.template_environment.undefined,
+                loader=self.template_environment.loader,
+                bytecode_cache=self.template_environment.bytecode_cache,
+                extensions=[StaticIncludeExtension],
+                auto_reload=self.auto_reload,
+                enable_async=True
+            )
+        return self._async_template_environment
+
+    def _new_render_context(self, environment: 'jinja2.Environment', template_name: str, args, kwargs):
+        """
+        Creates a context for rendering template_name through _render_blocks.html, with a collector on top of each
+        block's inheritance stack. Rendered blocks are recorded in the returned dict as the template renders them.
+        """
+        if self.metrics:
+            # Load the template up front, so that its lookup is timed apart from rendering.
+            with timed(self.metrics, 'render.lookup', {'template': template_name}):
+                environment.get_template(template_name)
+
+        render_template = environment.get_template('_render_blocks.html')
+        kwargs['templatemail__base_template'] = template_name
+        context = render_template.new_context(dict(*args, **kwargs))
+
+        rendered_blocks = {}
+        for block in _rendered_blocks:
+            if environment.is_async:
+                collector = self._async_block_collector(block, rendered_blocks, template_name)
+            else:
+                collector = self._block_collector(block, rendered_blocks, template_name)
+            context.blocks[block] = [collector]
+        return render_template, context, rendered_blocks
+
+    def _block_collector(self, block: str, rendered_blocks: dict, template_name: str):
+        """
+        Returns a block function which sits on top of a block's inheritance stack, records the first rendering of
+        that block and passes the output through, so self.<block>() calls within templates keep working.
+        """
+        metrics = self.metrics
+        tags = {'template': template_name, 'block': block}
+
+        def collect_block(context):
+            stack = context.blocks[block]
+            if len(stack) < 2:
+                context.environment.undefined(f'there is no block called {block!r}.', name=block)()
+            first_rendering = block not in rendered_blocks
+            with timed(metrics if first_rendering else None, 'render.block', tags):
+                content = context.environment.concat(stack[1](context))
+            if first_rendering:
+                rendered_blocks[block] = content
+                if metrics:
+                    metrics.histogram('render.block_size', len(content), tags)
+            yield content
+
+        return collect_block
+
+    def _async_block_collector(self, block: str, rendered_blocks: dict, template_name: str):
+        """
+        Async counterpart of _block_collector, for async-enabled environments.
+        """
+        metrics = self.metrics
+        tags = {'template': template_name, 'block': block}
+
+        async def collect_block(context):
+            stack = context.blocks[block]
+            if len(stack) < 2:
+                context.environment.undefined(f'there is no block called {block!r}.', name=block)()
+            first_rendering = block not in rendered_blocks
+            with timed(metrics if first_rendering else None, 'render.block', tags):
+                content = context.environment.concat([n async for n in stack[1](context)])
+            if first_rendering:
+                rendered_blocks[block] = content
+                if metrics:
+                    metrics.histogram('render.block_size', len(content), tags)
+            yield content
+
+        return collect_block
 
     def _render_partial(self, template_name: str, block: str, *args, **kwargs, ) -> str:
+        """
+        Renders a single block of template_name. Deprecated: render renders every block in one pass, and no longer
+        calls this. It is kept for subclasses which call it, and will be removed in a future release.
+        """
+        warnings.warn('TemplateMail._render_partial is deprecated; use render instead', DeprecationWarning,
+                      stacklevel=2)
         render_template = self.template_environment.get_template(f'_render_{block}.html')
         kwargs['templatemail__base_template'] = template_name
         content = render_template.render(*args, **kwargs)
@@ -67,7 +551,195 @@ class TemplateMail:
 
         rendered_email = self.render(template_name=template_name, *args, **kwargs)
 
+        if self.delivery_queue and not dry_run:
+            future = self.delivery_queue.submit_call(self.delivery_engine, self._deliver, template_name, from_address,
+                                                     to_addresses, rendered_email, headers)
+
+            def log_delivery(delivery: Future):
+                if not delivery.cancelled() and delivery.exception() is None:
+                    self.log_email(
+                        from_address=from_address,
+                        to_addresses=to_addresses,
+                        template_name=template_name,
+                        dry_run=dry_run
+                    )
+
+            future.add_done_callback(log_delivery)
+            return future
+
         if not dry_run:
+            self._deliver(template_name, from_address, to_addresses, rendered_email, headers)
+        self.log_email(
+            from_address=from_address,
+            to_addresses=to_addresses,
+            template_name=template_name,
+            dry_run=dry_run
+        )
+
+    async def send_email_async(self, from_address: str, to_addresses: List[str], template_name: str, dry_run=False,
+                               headers=None, *args, **kwargs):
+        """
+        Renders and sends an email like send_email, but as a coroutine. The delivery engine should be an AsyncEngine;
+        a blocking Engine is run in the event loop's default executor instead.
+        """
+        if not (self.delivery_engine or dry_run):
+            raise DeliveryEngineNotInstalled
+
+        rendered_email = await self.render_async(template_name, *args, **kwargs)
+
+        if not dry_run:
+            if isinstance(self.delivery_engine, AsyncEngine):
+                await self._deliver_async(template_name, from_address, to_addresses, rendered_email, headers)
+            else:
+                import asyncio
+
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._deliver, template_name, from_address, to_addresses, rendered_email, headers)
+        self.log_email(
+            from_address=from_address,
+            to_addresses=to_addresses,
+            template_name=template_name,
+            dry_run=dry_run
+        )
+
+    def send_many(self, template_name: str, from_address: str, recipients: Iterable[Tuple[List[str], Dict]],
+                  dry_run=False, headers=None, max_pending: int = 16, processes: int = None,
+                  delivery_threads: int = 1) -> List[SendResult]:
+        """
+        Renders and sends one template to many recipients, each with their own context. Recipients are consumed
+        lazily, and each email is rendered while the previous ones are being delivered in background threads.
+        A context which fails to render, or an email which fails to deliver, does not stop the run; the error is
+        recorded in the returned report instead.
+
+        :param template_name: Name of the template to render
+        :param from_address: From address
+        :param recipients: Iterable of (to_addresses, context) pairs. to_addresses may be a single address.
+        :param dry_run: Render each email, but do not deliver it
+        :param headers: Other email headers to include in every email
+        :param max_pending: Maximum number of rendered emails waiting to be delivered at once
+        :param processes: Render in this many worker processes, as render_many does. Defaults to None, to render in
+            this thread.
+        :param delivery_threads: Number of threads delivering email at once. The delivery engine must be safe to use
+            from several threads if this is more than 1.
+        :return: A SendResult per recipient, in the order the recipients were given
+        """
+        if not (self.delivery_engine or dry_run):
+            raise DeliveryEngineNotInstalled
+
+        if processes:
+            from .bulk_render import render_in_processes
+
+            rendered_emails = render_in_processes(self._worker_factory(), self._worker_kwargs(), template_name,
+                                                  recipients, processes=processes, return_exceptions=True)
+        else:
+            rendered_emails = self._render_each(template_name, recipients)
+
+        results = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=delivery_threads) as executor:
+            for to_addresses, rendered_email in rendered_emails:
+                if isinstance(to_addresses, str):
+                    to_addresses = [to_addresses]
+
+                if isinstance(rendered_email, Exception):
+                    future = Future()
+                    future.set_exception(rendered_email)
+                elif dry_run:
+                    future = None
+                else:
+                    future = executor.submit(self._deliver, template_name, from_address, to_addresses, rendered_email,
+                                             headers)
+                pending.append((to_addresses, future))
+
+                while len(pending) >= max_pending:
+                    results.append(self._collect_send_result(template_name, from_address, dry_run, *pending.popleft()))
+            while pending:
+                results.append(self._collect_send_result(template_name, from_address, dry_run, *pending.popleft()))
+        return results
+
+    def _render_each(self, template_name: str, recipients: Iterable[Tuple[List[str], Dict]]):
+        """
+        Renders template_name for each recipient, yielding the exception raised in place of the rendering of any
+        context which fails to render.
+        """
+        for to_addresses, context in recipients:
+            try:
+                yield to_addresses, self.render(template_name, context)
+            except Exception as e:
+                yield to_addresses, e
+
+    def queue_many(self, template_name: str, from_address: str, recipients: Iterable[Tuple[List[str], Dict]],
+                   outbox, headers=None, processes: int = None) -> int:
+        """
+        Renders one template for many recipients, each with their own context, and adds the emails to a durable
+        Outbox, to be delivered by its drain method. Each email is keyed by the template name and its to addresses;
+        recipients who already have this template in the outbox are skipped without being rendered, so a send
+        interrupted part way through can be run again from the start.
+
+        :param template_name: Name of the template to render
+        :param from_address: From address
+        :param recipients: Iterable of (to_addresses, context) pairs. to_addresses may be a single address.
+        :param outbox: templatemail.outbox.Outbox to add the emails to
+        :param headers: Other email headers to include in every email
+        :param processes: Render in this many worker processes, as render_many does. Defaults to None, to render in
+            this thread.
+        :return: Number of emails added to the outbox
+        """
+        def outbox_key(to_addresses):
+            return f'{template_name} {",".join(to_addresses)}'
+
+        recipients = (([to_addresses] if isinstance(to_addresses, str) else list(to_addresses), context)
+                      for to_addresses, context in recipients)
+        recipients = ((to_addresses, context) for to_addresses, context in recipients
+                      if outbox_key(to_addresses) not in outbox)
+        if processes:
+            from .bulk_render import render_in_processes
+
+            rendered_emails = render_in_processes(self._worker_factory(), self._worker_kwargs(), template_name,
+                                                  recipients, processes=processes)
+        else:
+            rendered_emails = ((to_addresses, self.render(template_name, context))
+                               for to_addresses, context in recipients)
+
+        added = 0
+        for to_addresses, rendered_email in rendered_emails:
+            added += outbox.add(outbox_key(to_addresses), template_name, from_address, to_addresses, rendered_email,
+                                headers)
+        outbox.flush()
+        return added
+
+    def _collect_send_result(self, template_name: str, from_address: str, dry_run: bool, to_addresses: List[str],
+                             future: Future) -> SendResult:
+        if future:
+            try:
+                future.result()
+            except Exception as e:
+                details = e.details if isinstance(e, DeliveryNotMade) else e
+                self.logger.warning(f'Could not send {template_name} to {to_addresses}: {details}')
+                return SendResult(to_addresses, False, e)
+        self.log_email(
+            from_address=from_address,
+            to_addresses=to_addresses,
+            template_name=template_name,
+            dry_run=dry_run
+        )
+        return SendResult(to_addresses, True, None)
+
+    async def _deliver_async(self, template_name: str, from_address: str, to_addresses: List[str],
+                             rendered_email: RenderedResult, headers=None):
+        with timed(self.metrics, 'delivery', self._delivery_tags(template_name)):
+            await self.delivery_engine.send_simple_message(
+                from_address=from_address,
+                to_addresses=to_addresses,
+                subject=rendered_email.subject,
+                text_body=rendered_email.text_body,
+                html_body=rendered_email.html_body,
+                headers=headers
+            )
+
+    def _deliver(self, template_name: str, from_address: str, to_addresses: List[str], rendered_email: RenderedResult,
+                 headers=None):
+        with timed(self.metrics, 'delivery', self._delivery_tags(template_name)):
             self.delivery_engine.send_simple_message(
                 from_address=from_address,
                 to_addresses=to_addresses,
@@ -76,16 +748,14 @@ class TemplateMail:
                 html_body=rendered_email.html_body,
                 headers=headers
             )
-        self.log_email(
-            from_address=from_address,
-            to_addresses=to_addresses,
-            template_name=template_name,
-            dry_run=dry_run
-        )
+
+    def _delivery_tags(self, template_name: str) -> Dict[str, str]:
+        return {'template': template_name, 'engine': type(self.delivery_engine).__name__}
 
     def log_email(self, from_address: str, to_addresses: List[str], template_name: str, dry_run: bool):
         prefix = "[Dry run] " if dry_run else ''
         self.logger.info(f'{prefix}Sending {template_name} to {to_addresses} from {from_address}')
 
 
-__all__ = ['TemplateMail', 'DeliveryEngineNotInstalled', 'DeliveryNotMade']
+__all__ = ['TemplateMail', 'DeliveryQueue', 'MetricsSink', 'StatsdMetricsSink', 'RenderCache', 'RenderCacheStats',
+           'SendResult', 'ValidationFailure', 'DeliveryEngineNotInstalled', 'DeliveryNotMade']
@@ -0,0 +1,37 @@
+"""
+Command line tools for templatemail.
+
+Compile templates into a bytecode cache ahead of time, eg. as a build step:
+
+    python -m templatemail warm-up --bytecode-cache-dir /app/template-cache /app/email_templates
+"""
+import argparse
+import os
+
+from . import TemplateMail
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m templatemail', description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    warm_up_parser = subparsers.add_parser(
+        'warm-up', help='Compile every template into a bytecode cache directory.')
+    warm_up_parser.add_argument('template_dirs', nargs='*', help='Directories containing templates')
+    warm_up_parser.add_argument('--bytecode-cache-dir', required=True,
+                                help='Directory to write compiled templates to. Created if it does not exist.')
+    warm_up_parser.add_argument('--extension', dest='extensions', action='append',
+                                help='Only compile templates with this file extension. May be repeated.')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'warm-up':
+        os.makedirs(args.bytecode_cache_dir, exist_ok=True)
+        mailer = TemplateMail(template_dirs=[os.path.abspath(path) for path in args.template_dirs],
+                              bytecode_cache_dir=args.bytecode_cache_dir)
+        template_names = mailer.warm_up(extensions=args.extensions)
+        print(f'Compiled {len(template_names)} templates into {args.bytecode_cache_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Rendering large numbers of emails across a pool of processes.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+# The TemplateMail each worker process renders with, built by _init_worker.
+_worker_mailer = None
+
+
+def render_in_processes(mailer_class: type, mailer_kwargs: Dict, template_name: str,
+                        items: Iterable[Tuple[Any, Dict]], processes: int = None,
+                        chunk_size: int = 100, return_exceptions: bool = False) -> Iterator[Tuple[Any, Any]]:
+    """
+    Renders template_name with each context in items, across a pool of worker processes, each with its own
+    mailer_class(**mailer_kwargs). Items are (tag, context) pairs; tags stay in this process and are yielded back
+    alongside each rendering, in the order the items were given. Only a few chunks per process are in flight at
+    once, so items may be a lazy iterable of any length. With return_exceptions, an item which fails to render
+    yields the exception it raised in place of its rendering, rather than stopping the run.
+    """
+    processes = processes or os.cpu_count() or 1
+    items = iter(items)
+    pending = deque()
+
+    executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                   initargs=(mailer_class, mailer_kwargs))
+    try:
+        while True:
+            while len(pending) < processes * 2:
+                chunk = list(islice(items, chunk_size))
+                if not chunk:
+                    break
+                tags = [tag for tag, _ in chunk]
+                pending.append((tags, executor.submit(_render_chunk, template_name, [c for _, c in chunk],
+                                                              return_exceptions)))
+            if not pending:
+                break
+
+            tags, future = pending.popleft()
+            yield from zip(tags, future.result())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _init_worker(mailer_class: type, mailer_kwargs: Dict):
+    global _worker_mailer
+    _worker_mailer = mailer_class(**mailer_kwargs)
+
+
+def _render_chunk(template_name: str, contexts: List[Dict], return_exceptions: bool = False) -> List:
+    if not return_exceptions:
+        return [_worker_mailer.render(template_name, context) for context in contexts]
+    return [_render_or_exception(template_name, context) for context in contexts]
+
+
+def _render_or_exception(template_name: str, context: Dict):
+    try:
+        return _worker_mailer.render(template_name, context)
+    except Exception as e:
+        return e
@@ -0,0 +1,140 @@
+"""
+Background delivery of rendered email through a pool of worker threads.
+"""
+import contextlib
+import functools
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+from .engines import Engine
+
+
+class DeliveryQueue:
+    def __init__(self, workers: int = 4, max_size: int = 1000, max_concurrency_per_engine: int = None):
+        """
+        A bounded queue of messages waiting to be delivered, drained by a pool of worker threads. Install one in
+        TemplateMail to have send_email return as soon as the email is rendered.
+
+        :param workers: Number of worker threads delivering messages
+        :param max_size: Maximum number of messages waiting in the queue. Once it is full, submitting another message
+            blocks until a worker takes one off the queue.
+        :param max_concurrency_per_engine: Maximum number of messages delivered through any one engine at once.
+            Defaults to None, in which case every worker may use the same engine at once.
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self.max_concurrency_per_engine = max_concurrency_per_engine
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._engine_semaphores = {}
+        self._lock = threading.Lock()
+        self._submitted = threading.Condition(self._lock)
+        self._submitting = 0
+        self._shutdown = False
+
+    def submit(self, engine: Engine, **message) -> Future:
+        """
+        Queues a message for delivery. Blocks while the queue is full.
+
+        :param engine: Engine to deliver the message with
+        :param message: Keyword arguments for the engine's send_simple_message
+        :return: A Future which completes once the message is delivered, or raises what the engine raised.
+        """
+        return self.submit_call(engine, engine.send_simple_message, **message)
+
+    def submit_call(self, engine: Engine, deliver: Callable, *args, **kwargs) -> Future:
+        """
+        Queues a call which delivers a message through engine, such as a wrapper around its send_simple_message
+        which records metrics. Blocks while the queue is full.
+
+        :param engine: Engine the message is delivered with, whose max_concurrency_per_engine applies to the call
+        :param deliver: Function to call from a worker thread with args and kwargs
+        :return: A Future which completes once deliver returns, or raises what it raised.
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot submit messages after the delivery queue is shut down')
+            if not self._threads:
+                self._start_workers()
+            self._submitting += 1
+        try:
+            # The put happens outside the lock, as it may block until a worker makes room, but shutdown waits for it
+            # so the message is never queued behind the workers' stop signals.
+            self._queue.put((future, engine, functools.partial(deliver, *args, **kwargs)))
+        finally:
+            with self._lock:
+                self._submitting -= 1
+                self._submitted.notify_all()
+        return future
+
+    def flush(self):
+        """
+        Blocks until every queued message has been delivered, or has failed.
+        """
+        self._queue.join()
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops accepting messages and stops the workers once the messages already queued are delivered.
+
+        :param wait: Block until the queue is drained and the workers have stopped.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            self._submitted.wait_for(lambda: self._submitting == 0)
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'templatemail-delivery-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                future, engine, deliver = item
+                if future.set_running_or_notify_cancel():
+                    with self._get_engine_semaphore(engine):
+                        try:
+                            deliver()
+                        except BaseException as e:
+                            future.set_exception(e)
+                        else:
+                            future.set_result(None)
+            finally:
+                self._queue.task_done()
+
+    def _get_engine_semaphore(self, engine: Engine):
+        if self.max_concurrency_per_engine is None:
+            return contextlib.nullcontext()
+        with self._lock:
+            semaphore = self._engine_semaphores.get(engine)
+            if semaphore is None:
+                semaphore = self._engine_semaphores[engine] = threading.BoundedSemaphore(
+                    self.max_concurrency_per_engine)
+            return semaphore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+__all__ = ['DeliveryQueue']
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from typing import List, Dict
+
+import aiohttp
+
+from . import AsyncEngine
+from .mailgun import DEFAULT_BASE_URL, MailgunDeliveryEngine, _payload_size
+from .. import DeliveryNotMade
+from ..metrics import MetricsSink
+
+
+class AsyncMailgunDeliveryEngine(AsyncEngine):
+    def __init__(self, api_key, domain_name, max_retries: int = 3, backoff_factor: float = 0.5,
+                 retry_server_errors: bool = False, pool_size: int = 100, base_url: str = DEFAULT_BASE_URL,
+                 metrics: MetricsSink = None):
+        """
+        Asyncio Mailgun delivery engine for templatemail, built on aiohttp. Requests are made over a shared,
+        keep-alive session, which is created on first use and should be closed with close() when you are done.
+
+        :param api_key: Mailgun API key
+        :param domain_name: Mailgun domain to send from
+        :param max_retries: Number of times to retry a request that was rate limited (HTTP 429), or that could not
+            connect to Mailgun, with backoff
+        :param backoff_factor: Backoff factor between retries, in seconds. The nth retry waits
+            backoff_factor * 2 ** (n - 1) seconds.
+        :param retry_server_errors: Also retry on HTTP 500, 502, 503 and 504, and on connections lost or timed out
+            after the request was sent. Note that a message may then be delivered twice if Mailgun accepted it before
+            failing.
+        :param pool_size: Maximum number of simultaneous connections to Mailgun
+        :param base_url: Mailgun API URL, eg. EU_BASE_URL for domains in Mailgun's EU region
+        :param metrics: MetricsSink to record API request timings and payload sizes to
+        """
+        self.api_key = api_key
+        self.domain_name = domain_name
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = {429, 500, 502, 503, 504} if retry_server_errors else {429}
+        # Failing to connect means the request was never sent, so it is always safe to retry.
+        self.retry_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError) if retry_server_errors else \
+            (aiohttp.ClientConnectorError,)
+        self.pool_size = pool_size
+        self.metrics = metrics
+        self._session = None
+
+    async def send_simple_message(self, from_address: str, to_addresses: List[str], subject: str,
+                                  text_body: str = None, html_body: str = None, headers: Dict = None):
+        data = MailgunDeliveryEngine._message_data(from_address, to_addresses, subject, text_body, html_body, headers)
+        fields = [(k, value) for k, v in data.items() for value in (v if isinstance(v, list) else [v])]
+        tags = {'engine': type(self).__name__}
+        if self.metrics:
+            self.metrics.histogram('mailgun.payload_size', _payload_size(data), tags)
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            started = time.perf_counter()
+            try:
+                async with self._get_session().post(f"{self.base_url}/{self.domain_name}/messages",
+                                                    auth=aiohttp.BasicAuth("api", self.api_key),
+                                                    data=aiohttp.FormData(fields)) as response:
+                    status = response.status
+                    await response.read()
+            except Exception as e:
+                if self.metrics:
+                    self.metrics.increment('mailgun.request.errors', dict(tags, error=type(e).__name__))
+                if isinstance(e, self.retry_errors) and attempt < self.max_retries:
+                    continue
+                raise
+            if self.metrics:
+                self.metrics.timing('mailgun.request', time.perf_counter() - started, dict(tags, status=str(status)))
+            if status not in self.retry_statuses:
+                break
+
+        if status < 200 or status > 299:
+            raise DeliveryNotMade(details=f"Got unexpected status from mailgun: {status}", response=response)
+
+    async def close(self):
+        """
+        Closes the keep-alive connections to Mailgun.
+        """
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._session
+
+
+__all__ = ['AsyncMailgunDeliveryEngine']
@@ -0,0 +1,80 @@
+import ssl
+import warnings
+from typing import List, Dict
+
+import aiosmtplib
+
+from . import AsyncEngine
+from .smtp import SMTPSecurity, SMTPError, _build_message
+from ..metrics import MetricsSink, timed
+
+
+class AsyncSMTPDeliveryEngine(AsyncEngine):
+    def __init__(self, host: str, port: int, security: SMTPSecurity, username: str = None, password: str = None,
+                 timeout: float = 60.0, metrics: MetricsSink = None):
+        """
+        Asyncio SMTP delivery engine for templatemail, built on aiosmtplib. Like SMTPDeliveryEngine, this engine is
+        not thoroughly tested against a variety of SMTP servers, so verify it works well for yours before proceeding.
+
+        :param host: Host to connect to
+        :param port: Port (there is no default because there are so many SMTP ports, you need to just get this right.)
+        :param security: Security to use. One of SMTPSecurity.
+        :param username: Username to use. Defaults to None, in which case a login is not attempted.
+        :param password: Password to use, in conjunction with username
+        :param timeout: Seconds to wait on the server before giving up
+        :param metrics: MetricsSink to record connection, message building and transfer timings to
+        """
+        self.host = host
+        self.port = port
+        self.security = security
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.metrics = metrics
+        self._metric_tags = {'engine': type(self).__name__}
+
+        warnings.warn('AsyncSMTPDeliveryEngine is a new and not thoroughly tested feature of templatemail.')
+
+    async def send_simple_message(self, from_address: str, to_addresses: List[str], subject: str,
+                                  text_body: str = None, html_body: str = None, headers: Dict = None):
+        with timed(self.metrics, 'smtp.build_message', self._metric_tags):
+            message = _build_message(from_address=from_address,
+                                     to_addresses=to_addresses,
+                                     subject=subject,
+                                     text_body=text_body,
+                                     html_body=html_body,
+                                     headers=headers)
+        if self.metrics:
+            self.metrics.histogram('smtp.message_size', len(message), self._metric_tags)
+
+        server = self._get_server()
+        try:
+            with timed(self.metrics, 'smtp.connect', self._metric_tags):
+                await server.connect()
+                if self.username and self.password:
+                    await server.login(self.username, self.password)
+            with timed(self.metrics, 'smtp.transfer', self._metric_tags):
+                await server.sendmail(from_address, to_addresses, message)
+            await server.quit()
+        except (aiosmtplib.SMTPException, OSError) as e:
+            server.close()
+            raise SMTPError(details=f"Could not deliver message over SMTP: {e}") from e
+        except BaseException:
+            server.close()
+            raise
+
+    def _get_server(self) -> aiosmtplib.SMTP:
+        if self.security == SMTPSecurity.START_TLS:
+            return aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout, use_tls=False,
+                                   start_tls=True, tls_context=ssl.create_default_context())
+        elif self.security == SMTPSecurity.SSL:
+            return aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout, use_tls=True,
+                                   tls_context=ssl.create_default_context())
+        elif self.security == SMTPSecurity.NONE:
+            return aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout, use_tls=False,
+                                   start_tls=False)
+        else:
+            raise ValueError('Unexpected security: %r' % self.security)
+
+
+__all__ = ['AsyncSMTPDeliveryEngine']
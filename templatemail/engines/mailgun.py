@@ -1,19 +1,102 @@
+import json
+import time
 from typing import List, Dict
 
-import requests
-
 from . import Engine
 from .. import DeliveryNotMade
+from ..metrics import MetricsSink
+
+DEFAULT_BASE_URL = 'https://api.mailgun.net/v3'
+EU_BASE_URL = 'https://api.eu.mailgun.net/v3'
+
+# Mailgun accepts at most this many recipients in a single batch call.
+MAX_BATCH_SIZE = 1000
 
 
 class MailgunDeliveryEngine(Engine):
-    def __init__(self, api_key, domain_name):
+    def __init__(self, api_key, domain_name, max_retries: int = 3, backoff_factor: float = 0.5,
+                 retry_server_errors: bool = False, pool_size: int = 10, base_url: str = DEFAULT_BASE_URL,
+                 metrics: MetricsSink = None):
+        """
+        Mailgun delivery engine for templatemail. Requests are made over a shared, keep-alive HTTP session.
+
+        :param api_key: Mailgun API key
+        :param domain_name: Mailgun domain to send from
+        :param max_retries: Number of times to retry a request that was rate limited (HTTP 429), with backoff
+        :param backoff_factor: Backoff factor between retries, in seconds. See urllib3's Retry.
+        :param retry_server_errors: Also retry on HTTP 500, 502, 503 and 504. Note that a message may then be
+            delivered twice if Mailgun accepted it before failing.
+        :param pool_size: Number of keep-alive connections to Mailgun to hold open
+        :param base_url: Mailgun API URL, eg. EU_BASE_URL for domains in Mailgun's EU region
+        :param metrics: MetricsSink to record API request timings and payload sizes to
+        """
+        # requests is imported here, rather than with the module, so that importing the engine costs nothing in
+        # processes which never send through it.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
         self.api_key = api_key
         self.domain_name = domain_name
-        self._requests = requests
+        self.base_url = base_url
+        self.metrics = metrics
+
+        status_forcelist = [429, 500, 502, 503, 504] if retry_server_errors else [429]
+        retry = Retry(total=max_retries, read=0, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+                      allowed_methods=None, raise_on_status=False)
+        self._requests = requests.Session()
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_size)
+        self._requests.mount('https://', adapter)
+        self._requests.mount('http://', adapter)
 
     def send_simple_message(self, from_address: str, to_addresses: List[str], subject: str, text_body: str = None,
                             html_body: str = None, headers: Dict = None):
+        data = self._message_data(from_address, to_addresses, subject, text_body, html_body, headers)
+        response = self._post_message(data)
+        if response.status_code < 200 or response.status_code > 299:
+            raise DeliveryNotMade(details=f"Got unexpected status from mailgun: {response.status_code}",
+                                  response=response)
+
+    def send_batch_message(self, from_address: str, recipient_variables: Dict[str, Dict], subject: str,
+                           text_body: str = None, html_body: str = None, headers: Dict = None,
+                           batch_size: int = MAX_BATCH_SIZE):
+        """
+        Sends one message to many recipients using Mailgun's batch sending. Each recipient receives their own copy
+        of the message, with %recipient.<name>% placeholders in the subject and bodies replaced with their values
+        from recipient_variables. Recipients are sent in groups of batch_size per API call.
+
+        :param from_address: From address
+        :param recipient_variables: Mapping of each recipient address to a dict of that recipient's variables
+        :param subject: Subject of email
+        :param text_body: Text body. Leave None for HTML-only
+        :param html_body: HTML body. Leave None for Text-only
+        :param headers: Other email headers to include
+        :param batch_size: Number of recipients to send per API call, at most MAX_BATCH_SIZE
+        :raises DeliveryNotMade: Raised when a batch cannot be sent. Earlier batches will already have been sent.
+        """
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f'batch_size must be between 1 and {MAX_BATCH_SIZE}')
+
+        to_addresses = list(recipient_variables)
+        for start in range(0, len(to_addresses), batch_size):
+            batch = to_addresses[start:start + batch_size]
+            data = self._message_data(from_address, batch, subject, text_body, html_body, headers)
+            data['recipient-variables'] = json.dumps({address: recipient_variables[address] for address in batch})
+            response = self._post_message(data)
+            if response.status_code < 200 or response.status_code > 299:
+                raise DeliveryNotMade(details=f"Got unexpected status from mailgun: {response.status_code} "
+                                              f"({start} of {len(to_addresses)} recipients were already sent)",
+                                      response=response)
+
+    def close(self):
+        """
+        Closes the keep-alive connections to Mailgun.
+        """
+        self._requests.close()
+
+    @staticmethod
+    def _message_data(from_address: str, to_addresses: List[str], subject: str, text_body: str = None,
+                      html_body: str = None, headers: Dict = None) -> Dict:
         data = {"from":    from_address,
                 "to":      to_addresses,
                 "subject": subject}
@@ -24,11 +107,29 @@ class MailgunDeliveryEngine(Engine):
         if headers:
             for k, v in headers.items():
                 data['h:{}'.format(k)] = v
-        response = self._requests.post(
-            f"https://api.mailgun.net/v3/{self.domain_name}/messages",
-            auth=("api", self.api_key),
-            data=data
-        )
-        if response.status_code < 200 or response.status_code > 299:
-            raise DeliveryNotMade(details=f"Got unexpected status from mailgun: {response.status_code}",
-                                  response=response)
+        return data
+
+    def _post_message(self, data: Dict):
+        tags = {'engine': type(self).__name__}
+        if self.metrics:
+            self.metrics.histogram('mailgun.payload_size', _payload_size(data), tags)
+
+        started = time.perf_counter()
+        try:
+            response = self._requests.post(
+                f"{self.base_url}/{self.domain_name}/messages",
+                auth=("api", self.api_key),
+                data=data
+            )
+        except Exception as e:
+            if self.metrics:
+                self.metrics.increment('mailgun.request.errors', dict(tags, error=type(e).__name__))
+            raise
+        if self.metrics:
+            self.metrics.timing('mailgun.request', time.perf_counter() - started,
+                                dict(tags, status=str(response.status_code)))
+        return response
+
+
+def _payload_size(data: Dict) -> int:
+    return sum(len(data.get(field, '')) for field in ('subject', 'text', 'html'))
@@ -1,13 +1,24 @@
 import smtplib
 import ssl
+import threading
+import time
 import warnings
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.policy import compat32
 from enum import Enum
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional
 
 from . import Engine
 from .. import DeliveryNotMade
+from ..metrics import MetricsSink, timed
+
+
+# Messages are encoded with SMTP line endings, so sendmail can send the bytes as they are.
+_message_policy = compat32.clone(linesep='\r\n')
+
+# Pooled connections idle for longer than this many seconds are checked with NOOP before being reused.
+_HEALTH_CHECK_AFTER = 5.0
 
 
 class SMTPError(DeliveryNotMade):
@@ -20,8 +31,22 @@ class SMTPSecurity(Enum):
     START_TLS = 'StartTLS'
 
 
+class _PooledConnection:
+    """
+    An open SMTP connection along with the bookkeeping needed to decide whether it can be reused.
+    """
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.last_used = time.monotonic()
+        self.messages_sent = 0
+        self.reused = False
+        self.data_started = False
+
+
 class SMTPDeliveryEngine(Engine):
-    def __init__(self, host: str, port: int, security: SMTPSecurity, username: str = None, password: str = None):
+    def __init__(self, host: str, port: int, security: SMTPSecurity, username: str = None, password: str = None,
+                 pool_size: int = 0, idle_timeout: float = 60.0, max_messages_per_connection: int = 100,
+                 metrics: MetricsSink = None):
         """
         SMTP delivery engine for templatemail. NOTE: This feature is not fully tested and SMTP is easy to get wrong.
         The developer has not fully tested this engine, so verify it works well for your server before proceeding.
@@ -31,104 +56,252 @@ class SMTPDeliveryEngine(Engine):
         :param security: Security to use. One of SMTPSecurity.
         :param username: Username to use. Defaults to None, in which case a login is not attempted.
         :param password: Password to use, in conjunction with username
+        :param pool_size: Number of idle connections to keep open between messages. Defaults to 0, in which case a
+            new connection is made (and closed) for every message.
+        :param idle_timeout: Seconds a pooled connection may sit idle before it is closed instead of reused.
+        :param max_messages_per_connection: Number of messages to send over a pooled connection before replacing it.
+        :param metrics: MetricsSink to record connection, message building and transfer timings to
         """
         self.host = host
         self.port = port
         self.security = security
         self.username = username
         self.password = password
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_messages_per_connection = max_messages_per_connection
+        self.metrics = metrics
+        self._metric_tags = {'engine': type(self).__name__}
+
+        self._idle_connections = []
+        self._pool_lock = threading.Lock()
 
         warnings.warn('SMTPDeliveryEngine is a new and not thoroughly tested feature of templatemail.')
 
     def send_simple_message(self, from_address: str, to_addresses: List[str], subject: str, text_body: str = None,
                             html_body: str = None, headers: Dict = None):
-        args = dict(from_address=from_address,
-                    to_addresses=to_addresses,
-                    subject=subject,
-                    text_body=text_body,
-                    html_body=html_body,
-                    headers=headers)
-
-        if self.security == SMTPSecurity.START_TLS:
-            self._send_simple_message_start_tls(**args)
+        with timed(self.metrics, 'smtp.build_message', self._metric_tags):
+            message = _build_message(from_address=from_address,
+                                     to_addresses=to_addresses,
+                                     subject=subject,
+                                     text_body=text_body,
+                                     html_body=html_body,
+                                     headers=headers)
+        self._send_message(from_address, to_addresses, message)
+
+    def send_to_many(self, from_address: str, recipients: Iterable[List[str]], subject: str, text_body: str = None,
+                     html_body: str = None, headers: Dict = None):
+        """
+        Sends the same message separately to each list of to addresses in recipients. The message is encoded once
+        and reused for every delivery, with only its To header changed. Set pool_size to send every delivery over
+        the same connection.
+
+        :param from_address: From address
+        :param recipients: Iterable of to address lists, one per delivery
+        :param subject: Subject of email
+        :param text_body: Text body. Leave None for HTML-only
+        :param html_body: HTML body. Leave None for Text-only
+        :param headers: Other email headers to include, apart from To, which is set for each delivery
+        :raises SMTPError: Raised when a delivery fails. Earlier deliveries will already have been sent; the error's
+            details say how many.
+        """
+        if headers and any(name.lower() == 'to' for name in headers):
+            raise ValueError('headers cannot include To, which is set for each delivery')
+        with timed(self.metrics, 'smtp.build_message', self._metric_tags):
+            message = _build_message(from_address=from_address,
+                                     to_addresses=None,
+                                     subject=subject,
+                                     text_body=text_body,
+                                     html_body=html_body,
+                                     headers=headers)
+        for sent, to_addresses in enumerate(recipients):
+            try:
+                self._send_message(from_address, to_addresses, _to_header(to_addresses) + message)
+            except SMTPError as e:
+                raise SMTPError(details=f"{e.details} ({sent} deliveries were already sent)") from e.__cause__
+
+    def _send_message(self, from_address: str, to_addresses: List[str], message: bytes):
+        if self.metrics:
+            self.metrics.histogram('smtp.message_size', len(message), self._metric_tags)
+
+        try:
+            self._send_over_connection(from_address, to_addresses, message)
+        except (smtplib.SMTPException, OSError) as e:
+            raise SMTPError(details=f"Could not deliver message over SMTP: {e}") from e
+
+    def _send_over_connection(self, from_address: str, to_addresses: List[str], message: bytes):
+        connection = self._get_connection()
+        try:
+            self._transfer(connection, from_address, to_addresses, message)
+        except smtplib.SMTPServerDisconnected:
+            self._close_connection(connection)
+            # Once DATA is under way the server may have accepted the message, so it is never sent again.
+            if not connection.reused or connection.data_started:
+                raise
+            # The server dropped a pooled connection while it sat idle, before accepting anything; retry once over a
+            # fresh one.
+            connection = self._get_connection(reuse=False)
+            try:
+                self._transfer(connection, from_address, to_addresses, message)
+            except BaseException:
+                self._close_connection(connection)
+                raise
+        except BaseException:
+            self._close_connection(connection)
+            raise
+        self._release_connection(connection)
+
+    def _transfer(self, connection: _PooledConnection, from_address: str, to_addresses: List[str], message: bytes):
+        """
+        Sends a message as smtplib.SMTP.sendmail does, but a step at a time, noting when DATA starts.
+        """
+        server = connection.server
+        connection.data_started = False
+        with timed(self.metrics, 'smtp.transfer', self._metric_tags):
+            server.ehlo_or_helo_if_needed()
+            mail_options = [f'size={len(message)}'] if server.does_esmtp and server.has_extn('size') else []
+            code, response = server.mail(from_address, mail_options)
+            if code != 250:
+                _abort(server, code)
+                raise smtplib.SMTPSenderRefused(code, response, from_address)
+
+            refused = {}
+            for to_address in to_addresses:
+                code, response = server.rcpt(to_address)
+                if code not in (250, 251):
+                    refused[to_address] = (code, response)
+                if code == 421:
+                    server.close()
+                    raise smtplib.SMTPRecipientsRefused(refused)
+            if len(refused) == len(to_addresses):
+                _abort(server, code)
+                raise smtplib.SMTPRecipientsRefused(refused)
+
+            connection.data_started = True
+            code, response = server.data(message)
+            if code != 250:
+                _abort(server, code)
+                raise smtplib.SMTPDataError(code, response)
+
+    def close(self):
+        """
+        Closes all idle pooled connections.
+        """
+        with self._pool_lock:
+            connections, self._idle_connections = self._idle_connections, []
+        for connection in connections:
+            self._close_connection(connection)
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.security in (SMTPSecurity.START_TLS, SMTPSecurity.NONE):
+            server = smtplib.SMTP(self.host, self.port)
         elif self.security == SMTPSecurity.SSL:
-            self._send_simple_message_ssl(**args)
-        elif self.security == SMTPSecurity.NONE:
-            self._send_simple_message_no_security(**args)
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
         else:
             raise ValueError('Unexpected security: %r' % self.security)
 
-    def _send_simple_message_start_tls(self, from_address: str, to_addresses: List[str], subject: str,
-                                       text_body: str = None, html_body: str = None, headers: Dict = None):
-        context = ssl.create_default_context()
-
-        server = smtplib.SMTP(self.host, self.port)
-        server.ehlo()
-        server.starttls(context=context)
-        server.ehlo()
-        self._login_with_server(server)
-
-        self._do_delivery_with_server(server=server,
-                                      from_address=from_address,
-                                      to_addresses=to_addresses,
-                                      subject=subject,
-                                      text_body=text_body,
-                                      html_body=html_body,
-                                      headers=headers)
-
-    def _send_simple_message_no_security(self, from_address: str, to_addresses: List[str], subject: str,
-                                         text_body: str = None, html_body: str = None, headers: Dict = None):
-        context = ssl.create_default_context()
-
-        server = smtplib.SMTP(self.host, self.port)
-        server.ehlo()
-        self._login_with_server(server)
-
-        self._do_delivery_with_server(server=server,
-                                      from_address=from_address,
-                                      to_addresses=to_addresses,
-                                      subject=subject,
-                                      text_body=text_body,
-                                      html_body=html_body,
-                                      headers=headers)
-
-    def _send_simple_message_ssl(self, from_address: str, to_addresses: List[str], subject: str, text_body: str = None,
-                                 html_body: str = None, headers: Dict = None):
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(self.host, self.port, context=context) as server:
+        try:
+            if self.security == SMTPSecurity.START_TLS:
+                server.ehlo()
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            elif self.security == SMTPSecurity.NONE:
+                server.ehlo()
             self._login_with_server(server)
-            self._do_delivery_with_server(server=server,
-                                          from_address=from_address,
-                                          to_addresses=to_addresses,
-                                          subject=subject,
-                                          text_body=text_body,
-                                          html_body=html_body,
-                                          headers=headers)
+        except BaseException:
+            server.close()
+            raise
+        return server
+
+    def _get_connection(self, reuse: bool = True) -> _PooledConnection:
+        while reuse:
+            with self._pool_lock:
+                if not self._idle_connections:
+                    break
+                connection = self._idle_connections.pop()
+            idle_for = time.monotonic() - connection.last_used
+            if idle_for < self.idle_timeout and (idle_for < _HEALTH_CHECK_AFTER or self._is_alive(connection)):
+                connection.reused = True
+                return connection
+            self._close_connection(connection)
+        with timed(self.metrics, 'smtp.connect', self._metric_tags):
+            return _PooledConnection(self._connect())
+
+    def _release_connection(self, connection: _PooledConnection):
+        connection.messages_sent += 1
+        connection.last_used = time.monotonic()
+        connection.reused = False
+        if connection.messages_sent < self.max_messages_per_connection:
+            with self._pool_lock:
+                if len(self._idle_connections) < self.pool_size:
+                    self._idle_connections.append(connection)
+                    return
+        self._close_connection(connection, quit=True)
+
+    @staticmethod
+    def _is_alive(connection: _PooledConnection) -> bool:
+        try:
+            return connection.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close_connection(connection: _PooledConnection, quit: bool = False):
+        try:
+            if quit:
+                connection.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            connection.server.close()
 
     def _login_with_server(self, server):
         if self.username and self.password:
             server.login(self.username, self.password)
 
-    def _do_delivery_with_server(self, server: smtplib.SMTP, from_address: str, to_addresses: List[str], subject: str,
-                                 text_body: str = None, html_body: str = None, headers: Dict = None):
-        if html_body and text_body:
-            msg = MIMEMultipart('alternative')
-            msg.attach(MIMEText(text_body, "plain"))
-            msg.attach(MIMEText(html_body, "html"))
-        elif html_body:
-            msg = MIMEMultipart('alternative')
-            msg.attach(MIMEText(html_body, "html"))
-        elif text_body:
-            msg = MIMEText(text_body)
-        else:
-            raise ValueError('You must specify html, text, or both.')
-        msg['Subject'] = subject
-        msg['From'] = from_address
+
+def _abort(server: smtplib.SMTP, code: int):
+    """
+    Ends a transaction the server refused, as sendmail does: a 421 reply means the server is closing the connection.
+    """
+    if code == 421:
+        server.close()
+        return
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def _build_message(from_address: str, to_addresses: Optional[List[str]], subject: str, text_body: str = None,
+                   html_body: str = None, headers: Dict = None) -> bytes:
+    """
+    Builds a message and encodes it, once, into the bytes sent to the server. If to_addresses is None, the To
+    header is left out, for _to_header to prepend.
+    """
+    if html_body and text_body:
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(text_body, "plain"))
+        msg.attach(MIMEText(html_body, "html"))
+    elif html_body:
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(html_body, "html"))
+    elif text_body:
+        msg = MIMEText(text_body)
+    else:
+        raise ValueError('You must specify html, text, or both.')
+    msg['Subject'] = subject
+    msg['From'] = from_address
+    if to_addresses is not None:
         msg['To'] = ", ".join(to_addresses)
-        if headers:
-            for k, v in headers.items():
-                msg[k] = v
-        server.sendmail(from_address, to_addresses, msg.as_string())
+    if headers:
+        for k, v in headers.items():
+            msg[k] = v
+    return msg.as_bytes(policy=_message_policy)
+
+
+def _to_header(to_addresses: List[str]) -> bytes:
+    return _message_policy.fold_binary('To', ", ".join(to_addresses))
 
 
 __all__ = ['SMTPDeliveryEngine', 'SMTPSecurity', 'SMTPError']
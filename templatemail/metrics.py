@@ -0,0 +1,110 @@
+"""
+Instrumentation of rendering and delivery, through a pluggable metrics sink.
+"""
+import contextlib
+import time
+from abc import ABC
+from typing import Dict
+
+
+class MetricsSink(ABC):
+    """
+    Defines the interface for metrics sinks, which receive timings, sizes and counts from TemplateMail and the
+    delivery engines. Every metric is labelled with tags, such as the template name or engine.
+
+    Metrics recorded are:
+
+    * render (timing): Rendering a template, tagged with template
+    * render.lookup (timing): Loading, and if needed compiling, a template, tagged with template
+    * render.block (timing): Rendering one block, tagged with template and block
+    * render.block_size (histogram): Characters in a rendered block, tagged with template and block
+    * delivery (timing): Delivering a message through an engine, tagged with template and engine
+    * smtp.connect (timing): Connecting, TLS and login to an SMTP server, tagged with engine
+    * smtp.build_message (timing): Building the MIME message, tagged with engine
+    * smtp.transfer (timing): Sending a message to an SMTP server, tagged with engine
+    * smtp.message_size (histogram): Bytes in an encoded message, tagged with engine
+    * mailgun.request (timing): A Mailgun API request, tagged with engine and status
+    * mailgun.payload_size (histogram): Characters of subject and body sent to Mailgun, tagged with engine
+
+    Every timing which fails also increments a <name>.errors counter, tagged with error, the exception class.
+    """
+
+    def timing(self, name: str, seconds: float, tags: Dict[str, str]):
+        """
+        Records how long an operation took.
+        """
+        pass
+
+    def histogram(self, name: str, value: float, tags: Dict[str, str]):
+        """
+        Records a value, such as a size, whose distribution is of interest.
+        """
+        pass
+
+    def increment(self, name: str, tags: Dict[str, str], value: int = 1):
+        """
+        Increments a counter.
+        """
+        pass
+
+
+class StatsdMetricsSink(MetricsSink):
+    def __init__(self, host: str = 'localhost', port: int = 8125, prefix: str = 'templatemail'):
+        """
+        Sends metrics over UDP to a StatsD server, using DogStatsD tags. These are understood by the Datadog agent,
+        Telegraf and the Prometheus statsd_exporter, among others. Sending never blocks or raises.
+
+        :param host: StatsD host
+        :param port: StatsD port
+        :param prefix: Prefix for metric names
+        """
+        import socket
+
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def timing(self, name: str, seconds: float, tags: Dict[str, str]):
+        self._send(name, f'{seconds * 1000:.3f}', 'ms', tags)
+
+    def histogram(self, name: str, value: float, tags: Dict[str, str]):
+        self._send(name, value, 'h', tags)
+
+    def increment(self, name: str, tags: Dict[str, str], value: int = 1):
+        self._send(name, value, 'c', tags)
+
+    def close(self):
+        self._socket.close()
+
+    def _send(self, name: str, value, metric_type: str, tags: Dict[str, str]):
+        line = f'{self.prefix}.{name}:{value}|{metric_type}'
+        if tags:
+            line += '|#' + ','.join(f'{k}:{v}' for k, v in tags.items())
+        try:
+            self._socket.sendto(line.encode('utf8'), self.address)
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def timed(metrics: MetricsSink, name: str, tags: Dict[str, str]):
+    """
+    Records the time taken by the body of a with statement, and counts any exception it raises.
+    A metrics sink of None records nothing.
+    """
+    if metrics is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        metrics.increment(f'{name}.errors', dict(tags, error=type(e).__name__))
+        raise
+    finally:
+        metrics.timing(name, time.perf_counter() - started, tags)
+
+
+__all__ = ['MetricsSink', 'StatsdMetricsSink', 'timed']
@@ -0,0 +1,250 @@
+"""
+A durable, local outbox of rendered email, so that large sends can be resumed after a crash.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from . import DeliveryNotMade, RenderedResult
+from .engines import Engine
+from .metrics import MetricsSink, timed
+
+OutboxStats = namedtuple('OutboxStats', ('pending', 'delivered', 'failed'))
+
+_PENDING = 'pending'
+_SENDING = 'sending'
+_DELIVERED = 'delivered'
+_FAILED = 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    template_name TEXT NOT NULL,
+    from_address TEXT NOT NULL,
+    to_addresses TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    text_body TEXT,
+    html_body TEXT,
+    headers TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- For a message being sent, when its claim expires and another drain may send it.
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_due ON messages (state, next_attempt_at);
+"""
+
+
+class Outbox:
+    def __init__(self, path: str, batch_size: int = 100, max_attempts: int = 5, backoff: float = 1.0,
+                 max_backoff: float = 300.0, claim_timeout: float = 600.0, logger=None,
+                 metrics: MetricsSink = None):
+        """
+        A SQLite database of rendered email and its delivery state. Messages are added under a key, and a message
+        whose key is already in the outbox is not added again, so a send which is run again, after a crash or on
+        purpose, only delivers what was not delivered before.
+
+        Changes are committed in transactions of up to batch_size messages, rather than one per message. If the
+        process dies, messages added since the last commit are lost and will be added again when the send is run
+        again, and up to batch_size deliveries may not have been recorded and will be made again.
+
+        Several processes may drain the same outbox at once. Each claims a batch of messages before delivering it,
+        so no message is sent by two of them. Claims expire after claim_timeout, so the messages of a drain that
+        died are sent by the next one.
+
+        :param path: Path of the SQLite database. It is created if it does not exist.
+        :param batch_size: Number of messages added, or delivered, per transaction
+        :param max_attempts: Number of times a message is tried before it is marked failed
+        :param backoff: Seconds to wait before the first retry of a failed delivery. The wait doubles with each retry.
+        :param max_backoff: Maximum seconds to wait before a retry
+        :param claim_timeout: Seconds a batch of messages stays claimed by a drain. It must be longer than delivering
+            a batch takes.
+        :param metrics: MetricsSink to record delivery timings and errors to, as TemplateMail does
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self.path = path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self.logger = logger or logging.getLogger('templatemail')
+        self.metrics = metrics
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_schema)
+        self._lock = threading.Lock()
+        self._added = {}
+
+    def add(self, key: str, template_name: str, from_address: str, to_addresses: List[str],
+            rendered_email: RenderedResult, headers: Dict = None) -> bool:
+        """
+        Adds a rendered email to the outbox, to be delivered by drain.
+
+        :param key: Key identifying the message within the outbox, eg. the recipient's address, or a campaign name
+            and the recipient's address.
+        :return: False if a message with this key was already in the outbox, and so was not added.
+        """
+        if key in self:
+            return False
+        row = (key, template_name, from_address, json.dumps(to_addresses), rendered_email.subject,
+               rendered_email.text_body, rendered_email.html_body, json.dumps(headers) if headers else None)
+        with self._lock:
+            self._added[key] = row
+            if len(self._added) >= self.batch_size:
+                self._write_added()
+        return True
+
+    def flush(self):
+        """
+        Commits messages added since the last commit.
+        """
+        with self._lock:
+            self._write_added()
+
+    def drain(self, engine: Engine, workers: int = 4, wait_for_retries: bool = True) -> OutboxStats:
+        """
+        Delivers every pending message through engine, from a pool of worker threads. A delivery which raises
+        DeliveryNotMade, or a connection error or timeout, is retried after a backoff, up to max_attempts times in
+        all; a message which still cannot be delivered, or whose delivery raises any other error, is marked failed.
+        Messages claimed by another drain are left to it.
+
+        :param engine: Engine to deliver the messages with. It must be safe to use from several threads if workers
+            is more than 1.
+        :param workers: Number of messages delivered at once
+        :param wait_for_retries: Wait for messages whose retry is not yet due, rather than leaving them pending.
+        :return: OutboxStats of the messages in the outbox once drained
+        """
+        self.flush()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                messages = self._due_messages()
+                if not messages:
+                    next_attempt_at = self._next_attempt_at()
+                    if next_attempt_at is None or not wait_for_retries:
+                        break
+                    time.sleep(max(0.0, next_attempt_at - time.time()))
+                    continue
+
+                outcomes = executor.map(lambda message: self._deliver(engine, message), messages)
+                self._record_outcomes(list(zip(messages, outcomes)))
+        return self.stats
+
+    @property
+    def stats(self) -> OutboxStats:
+        with self._lock:
+            counts = dict(self._connection.execute('SELECT state, COUNT(*) FROM messages GROUP BY state'))
+            return OutboxStats(counts.get(_PENDING, 0) + counts.get(_SENDING, 0) + len(self._added),
+                               counts.get(_DELIVERED, 0),
+                               counts.get(_FAILED, 0))
+
+    def close(self):
+        """
+        Commits messages added since the last commit, and closes the database.
+        """
+        with self._lock:
+            self._write_added()
+            self._connection.close()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._added:
+                return True
+            return self._connection.execute('SELECT 1 FROM messages WHERE key = ?', (key,)).fetchone() is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_added(self):
+        if not self._added:
+            return
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO messages (key, template_name, from_address, to_addresses, subject, text_body, '
+                'html_body, headers) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._added.values())
+        self._added.clear()
+
+    def _due_messages(self) -> list:
+        """
+        Claims and returns up to batch_size messages which are due, including those whose claim has expired.
+        """
+        with self._lock, self._connection:
+            # An immediate transaction takes the write lock up front, so no other drain can claim the same messages.
+            self._connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            messages = self._connection.execute(
+                'SELECT id, template_name, from_address, to_addresses, subject, text_body, html_body, headers, '
+                'attempts FROM messages WHERE state IN (?, ?) AND next_attempt_at <= ? ORDER BY id LIMIT ?',
+                (_PENDING, _SENDING, now, self.batch_size)).fetchall()
+            self._connection.executemany(
+                'UPDATE messages SET state = ?, next_attempt_at = ? WHERE id = ?',
+                [(_SENDING, now + self.claim_timeout, message[0]) for message in messages])
+            return messages
+
+    def _next_attempt_at(self):
+        with self._lock:
+            return self._connection.execute('SELECT MIN(next_attempt_at) FROM messages WHERE state = ?',
+                                            (_PENDING,)).fetchone()[0]
+
+    def _deliver(self, engine: Engine, message):
+        _, template_name, from_address, to_addresses, subject, text_body, html_body, headers, _ = message
+        to_addresses = json.loads(to_addresses)
+        try:
+            with timed(self.metrics, 'delivery', {'template': template_name, 'engine': type(engine).__name__}):
+                engine.send_simple_message(
+                    from_address=from_address,
+                    to_addresses=to_addresses,
+                    subject=subject,
+                    text_body=text_body,
+                    html_body=html_body,
+                    headers=json.loads(headers) if headers else None
+                )
+        except DeliveryNotMade as e:
+            self.logger.warning(f'Could not send {template_name} to {to_addresses}: {e.details}')
+            return e, True
+        except OSError as e:
+            # Connection errors and timeouts, including those raised by requests and smtplib, are worth retrying.
+            self.logger.warning(f'Could not send {template_name} to {to_addresses}: {e}')
+            return e, True
+        except Exception as e:
+            self.logger.exception(f'Could not send {template_name} to {to_addresses}')
+            return e, False
+        self.logger.info(f'Sending {template_name} to {to_addresses} from {from_address}')
+        return None, False
+
+    def _record_outcomes(self, outcomes: list):
+        now = time.time()
+        updates = []
+        for message, (error, retry) in outcomes:
+            message_id, attempts = message[0], message[-1] + 1
+            if error is None:
+                updates.append((_DELIVERED, attempts, 0, None, message_id))
+            elif retry and attempts < self.max_attempts:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                updates.append((_PENDING, attempts, now + delay, str(error), message_id))
+            else:
+                updates.append((_FAILED, attempts, 0, str(error), message_id))
+
+        with self._lock, self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'UPDATE messages SET state = ?, attempts = ?, next_attempt_at = ?, error = ? '
+                'WHERE id = ? AND state = ?',
+                [update + (_SENDING,) for update in updates])
+
+
+__all__ = ['Outbox', 'OutboxStats']
@@ -0,0 +1,161 @@
+"""
+Caching of rendered email for templates rendered repeatedly with the same context.
+"""
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from typing import TYPE_CHECKING
+
+from markupsafe import Markup
+
+if TYPE_CHECKING:
+    import jinja2
+
+RenderCacheStats = namedtuple('RenderCacheStats', ('hits', 'misses', 'uncacheable', 'evictions', 'size'))
+
+# Context values of these types are rendered the same way every time, and so can be part of a cache key.
+_cacheable_scalar_types = (str, Markup, int, float, bool, bytes, type(None))
+
+
+class RenderCache:
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        """
+        A least-recently-used cache of rendered email, keyed by template name and context. Only contexts made up of
+        strings, numbers, booleans, None, and lists, tuples and dicts of those are cached; rendering with any
+        other value bypasses the cache. Cached renderings are discarded when the template, or any template it
+        extends, includes or imports by name, changes on disk.
+
+        :param max_size: Maximum number of renderings to keep. The least recently used one is evicted beyond this.
+        :param ttl: Seconds a rendering may be used for after it is cached. Defaults to None, for no expiry.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._dependencies = {}
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._uncacheable = self._evictions = 0
+
+    def key(self, environment: 'jinja2.Environment', template_name: str, context: dict, namespace: str = None):
+        """
+        Returns the cache key for rendering template_name with context, or None if the context cannot be cached.
+        Environments which load different templates under the same names must each use their own namespace.
+        """
+        try:
+            frozen_context = _freeze_context(context)
+        except TypeError:
+            with self._lock:
+                self._uncacheable += 1
+            return None
+        return namespace, template_name, self._template_version(environment, template_name, namespace), frozen_context
+
+    def get(self, key):
+        """
+        Returns the rendering cached under key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+            self._misses += 1
+            return None
+
+    def set(self, key, value):
+        """
+        Caches a rendering under key, evicting the least recently used renderings beyond max_size.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """
+        Discards every cached rendering.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._dependencies.clear()
+
+    @property
+    def stats(self) -> RenderCacheStats:
+        with self._lock:
+            return RenderCacheStats(self._hits, self._misses, self._uncacheable, self._evictions, len(self._entries))
+
+    def _template_version(self, environment: 'jinja2.Environment', template_name: str, namespace: str = None) -> int:
+        """
+        Returns a number which changes whenever template_name or a template it depends on changes on disk. Without
+        auto_reload, the environment keeps using the templates it has loaded, so the number instead changes when the
+        environment is replaced.
+        """
+        with self._lock:
+            version, uptodates, environment_ref = self._dependencies.get((namespace, template_name), (-1, (), None))
+        if version >= 0 and environment_ref() is environment and \
+                (not environment.auto_reload or all(uptodate() for uptodate in uptodates)):
+            return version
+
+        uptodates = _template_uptodates(environment, template_name)
+        with self._lock:
+            self._dependencies[namespace, template_name] = (version + 1, uptodates, weakref.ref(environment))
+        return version + 1
+
+
+def _template_uptodates(environment: 'jinja2.Environment', template_name: str) -> list:
+    """
+    Finds the uptodate functions of template_name and every template it refers to by a constant name.
+    """
+    import jinja2
+    from jinja2 import meta
+
+    uptodates = []
+    seen = set()
+    pending = [template_name]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source, _, uptodate = environment.loader.get_source(environment, name)
+        except jinja2.TemplateNotFound:
+            continue
+        if uptodate is not None:
+            uptodates.append(uptodate)
+        pending.extend(referenced for referenced in meta.find_referenced_templates(environment.parse(source))
+                       if referenced)
+    return uptodates
+
+
+def _freeze_context(context: dict):
+    """
+    Converts a template context into a hashable equivalent. Raises TypeError if it cannot safely be cached.
+    """
+    return tuple(sorted((name, _freeze(value)) for name, value in context.items()))
+
+
+def _freeze(value):
+    """
+    Converts a context value into a hashable equivalent, tagged with types so that eg. 1, 1.0 and True, which
+    render differently, do not collide. Dicts keep their order, since templates iterating over them see it.
+    Raises TypeError for values which cannot safely be cached.
+    """
+    value_type = type(value)
+    if value_type in _cacheable_scalar_types:
+        return value_type, value
+    elif value_type in (list, tuple):
+        return value_type, tuple(_freeze(item) for item in value)
+    elif value_type is dict:
+        return value_type, tuple((_freeze(k), _freeze(v)) for k, v in value.items())
+    raise TypeError(f'Cannot cache a rendering with a context value of type {value_type.__name__}')
+
+
+__all__ = ['RenderCache', 'RenderCacheStats']
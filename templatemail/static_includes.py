@@ -0,0 +1,126 @@
+"""
+Folding of static includes into the templates which include them, at compile time.
+
+A template included by a constant name, which itself contains only text, renders the same way every time. Rather
+than loading it and creating a new context for it on every render, StaticIncludeExtension replaces the include with
+the included text while the including template is compiled, so that it becomes part of the surrounding constant
+output. StaticIncludeLoader and StaticIncludeBytecodeCache account for the included templates, so that the
+including template is recompiled when one of them changes.
+"""
+from typing import List, Optional
+
+import jinja2
+from jinja2.ext import Extension
+from jinja2.lexer import Token, TOKEN_BLOCK_BEGIN, TOKEN_BLOCK_END, TOKEN_DATA, TOKEN_NAME, TOKEN_STRING
+
+
+class StaticIncludeExtension(Extension):
+    def filter_stream(self, stream):
+        statement = []
+        for token in stream:
+            if statement:
+                statement.append(token)
+                if token.type == TOKEN_BLOCK_END:
+                    yield from self._fold_statement(statement)
+                    statement = []
+            elif token.type == TOKEN_BLOCK_BEGIN:
+                statement.append(token)
+            else:
+                yield token
+        yield from statement
+
+    def _fold_statement(self, statement: List[Token]):
+        include_name = _constant_include(statement)
+        text = _static_text(self.environment, include_name) if include_name else None
+        if text is None:
+            yield from statement
+        elif text:
+            yield Token(statement[0].lineno, TOKEN_DATA, text)
+
+
+class StaticIncludeLoader(jinja2.FileSystemLoader):
+    """
+    A FileSystemLoader whose templates are out of date when a static template they include changes.
+    """
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        include_uptodates = [super(StaticIncludeLoader, self).get_source(environment, include_name)[2]
+                             for include_name in static_includes(environment, source)]
+        if include_uptodates:
+            own_uptodate = uptodate
+
+            def uptodate():
+                return own_uptodate() and all(include_uptodate() for include_uptodate in include_uptodates)
+        return source, filename, uptodate
+
+
+class StaticIncludeBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    A FileSystemBytecodeCache whose cached templates are stale when a static template they include changes.
+    """
+    def get_bucket(self, environment, name, filename, source):
+        return super().get_bucket(environment, name, filename, with_static_includes(environment, source))
+
+
+def static_includes(environment: jinja2.Environment, source: str) -> List[str]:
+    """
+    Returns the names of the static templates which source includes by a constant name.
+    """
+    include_names = []
+    statement = []
+    try:
+        for token in environment.lexer.tokenize(source):
+            if token.type == TOKEN_BLOCK_BEGIN:
+                statement = [token]
+            elif statement:
+                statement.append(token)
+                if token.type == TOKEN_BLOCK_END:
+                    include_name = _constant_include(statement)
+                    if include_name and _static_text(environment, include_name) is not None:
+                        include_names.append(include_name)
+                    statement = []
+    except jinja2.TemplateSyntaxError:
+        pass
+    return include_names
+
+
+def with_static_includes(environment: jinja2.Environment, source: str) -> str:
+    """
+    Returns source followed by the sources of the static templates it includes, for checksums which must change
+    when any of them does.
+    """
+    for include_name in static_includes(environment, source):
+        source += environment.loader.get_source(environment, include_name)[0]
+    return source
+
+
+def _constant_include(statement: List[Token]) -> Optional[str]:
+    """
+    Returns the template name of an include statement of the form {% include "name" %}, optionally followed by
+    "ignore missing" and "with context" or "without context", or None for any other statement.
+    """
+    values = [(token.type, token.value) for token in statement[1:-1]]
+    if len(values) < 2 or values[0] != (TOKEN_NAME, 'include') or values[1][0] != TOKEN_STRING:
+        return None
+    modifiers = values[2:]
+    if modifiers[:2] == [(TOKEN_NAME, 'ignore'), (TOKEN_NAME, 'missing')]:
+        modifiers = modifiers[2:]
+    if modifiers in ([], [(TOKEN_NAME, 'with'), (TOKEN_NAME, 'context')],
+                     [(TOKEN_NAME, 'without'), (TOKEN_NAME, 'context')]):
+        return values[1][1]
+    return None
+
+
+def _static_text(environment: jinja2.Environment, template_name: str) -> Optional[str]:
+    """
+    Returns the text of template_name if it contains only text, or None if it contains any template code or cannot
+    be loaded.
+    """
+    try:
+        source = environment.loader.get_source(environment, template_name)[0]
+        tokens = list(environment.lexer.tokenize(source, template_name))
+    except (jinja2.TemplateNotFound, jinja2.TemplateSyntaxError):
+        return None
+    if any(token.type != TOKEN_DATA for token in tokens):
+        return None
+    return ''.join(token.value for token in tokens)
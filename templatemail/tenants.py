@@ -0,0 +1,85 @@
+"""
+Support for serving many tenants, each with a template directory layered over the shared ones, from one TemplateMail.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+
+from .static_includes import with_static_includes
+
+
+class SharedBytecodeCache(jinja2.BytecodeCache):
+    def __init__(self, fallback: jinja2.BytecodeCache = None, max_size: int = 1024):
+        """
+        An in-memory cache of compiled templates, shared between template environments. Templates are keyed by name,
+        file and source, so a template every tenant loads from the same shared file is compiled once, and each
+        tenant environment only has to load the compiled code. Tenants' own templates live in different files and
+        so are cached apart. Only the latest compilation of each template is kept, and the least recently used
+        templates are evicted beyond max_size, so templates of tenants no longer served do not stay in memory.
+
+        :param fallback: A further cache, such as a FileSystemBytecodeCache, to load templates missing from memory
+            from, and to store newly compiled templates in.
+        :param max_size: Maximum number of compiled templates to keep in memory
+        """
+        self.fallback = fallback
+        self.max_size = max_size
+        self._code = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_bucket(self, environment, name, filename, source):
+        return super().get_bucket(environment, name, filename, with_static_includes(environment, source))
+
+    def load_bytecode(self, bucket):
+        code = None
+        with self._lock:
+            entry = self._code.get(bucket.key)
+            if entry is not None and entry[0] == bucket.checksum:
+                code = entry[1]
+                self._code.move_to_end(bucket.key)
+        if code is None and self.fallback is not None:
+            self.fallback.load_bytecode(bucket)
+            code = bucket.code
+            if code is not None:
+                self._store(bucket.key, bucket.checksum, code)
+        bucket.code = code
+
+    def dump_bytecode(self, bucket):
+        self._store(bucket.key, bucket.checksum, bucket.code)
+        if self.fallback is not None:
+            self.fallback.dump_bytecode(bucket)
+
+    def clear(self):
+        with self._lock:
+            self._code.clear()
+        if self.fallback is not None:
+            self.fallback.clear()
+
+    def __len__(self):
+        return len(self._code)
+
+    def _store(self, key: str, checksum: str, code):
+        # Storing under the template's key replaces any earlier compilation of it, eg. from before a reload.
+        with self._lock:
+            self._code[key] = (checksum, code)
+            self._code.move_to_end(key)
+            while len(self._code) > self.max_size:
+                self._code.popitem(last=False)
+
+
+def tenant_template_dir(tenant_template_root: str, tenant: str) -> str:
+    """
+    Returns the template directory of tenant under tenant_template_root.
+    """
+    if not tenant or tenant in (os.curdir, os.pardir) or os.path.basename(tenant) != tenant or \
+            (os.altsep and os.altsep in tenant):
+        raise ValueError(f'Invalid tenant name {tenant!r}')
+    return os.path.join(tenant_template_root, tenant)
+
+
+def tenant_mailer(mailer_class: type, tenant: str, **mailer_kwargs):
+    """
+    Builds a mailer_class(**mailer_kwargs) for tenant. Used to build tenant mailers in worker processes.
+    """
+    return mailer_class(**mailer_kwargs).for_tenant(tenant)
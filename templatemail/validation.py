@@ -0,0 +1,275 @@
+"""
+Static analysis of the variables a template needs, for validating contexts without rendering them.
+"""
+import copy
+from typing import FrozenSet, Iterable, Iterator, List, Set, Tuple
+
+import jinja2
+from jinja2 import meta, nodes
+from jinja2.visitor import NodeTransformer
+
+# Tests and filters which make a variable optional: a template using them copes with the variable being undefined.
+_optional_tests = {'defined', 'undefined'}
+_optional_filters = {'default', 'd'}
+
+
+def required_variables(environment: jinja2.Environment, template_name: str,
+                       blocks: Iterable[str] = ()) -> FrozenSet[str]:
+    """
+    Returns the names of the context variables template_name needs to render, found by following its extends
+    chain, the blocks which end up rendered, super() and self calls between them, the macros they call, and the
+    templates it includes by a constant name. Variables whose every use is guarded by the defined test or the
+    default filter are not required.
+
+    :param environment: Environment to load templates from
+    :param template_name: Name of the template
+    :param blocks: Blocks which are rendered on their own, as well as through the template's output
+    """
+    return frozenset(_Analysis(environment).required_variables(template_name, blocks))
+
+
+class _Analysis:
+    def __init__(self, environment: jinja2.Environment):
+        self.environment = environment
+        self._included = {}
+
+    def required_variables(self, template_name: str, blocks: Iterable[str] = ()) -> Set[str]:
+        chain = self._inheritance_chain(template_name)
+        definitions = {}
+        macros = {}
+        declared = set(self.environment.globals)
+        for ast in chain:
+            for block in ast.find_all(nodes.Block):
+                definitions.setdefault(block.name, []).append(block)
+            for node in ast.body:
+                if isinstance(node, nodes.Macro):
+                    macros.setdefault(node.name, node)
+            declared.update(_top_level_names(ast))
+
+        required = set()
+        visited = set()
+
+        def visit(body: list, block_name: str = None, depth: int = 0, scope: FrozenSet[str] = frozenset()):
+            for child, child_scope in _walk_body(body, scope):
+                if isinstance(child, nodes.Block):
+                    visit_block(child.name, 0, child_scope)
+                elif isinstance(child, nodes.Call) and isinstance(child.node, nodes.Name) and \
+                        child.node.name == 'super' and block_name is not None:
+                    visit_block(block_name, depth + 1, scope)
+                elif isinstance(child, nodes.Call) and isinstance(child.node, nodes.Getattr) and \
+                        isinstance(child.node.node, nodes.Name) and child.node.node.name == 'self':
+                    visit_block(child.node.attr, 0)
+                elif isinstance(child, nodes.Call) and isinstance(child.node, nodes.Name) and \
+                        child.node.name in macros and child.node.name not in child_scope:
+                    visit_macro(child.node.name)
+                elif isinstance(child, nodes.Include) and child.with_context and \
+                        isinstance(child.template, nodes.Const):
+                    # The included template sees the variables set around the include, as well as the context.
+                    required.update(self._include_variables(child.template.value, child.ignore_missing) - child_scope)
+
+            if block_name is None:
+                template = nodes.Template(_prepare(self.environment, body), lineno=1)
+                template.set_environment(self.environment)
+                required.update(meta.find_undeclared_variables(template))
+            else:
+                block = definitions[block_name][depth]
+                block = nodes.Block(block.name, _prepare(self.environment, body), block.scoped, block.required,
+                                    lineno=block.lineno)
+                template = nodes.Template([block], lineno=1)
+                template.set_environment(self.environment)
+                variables = meta.find_undeclared_variables(template)
+                # A scoped block also sees the variables of the loops and assignments around it.
+                required.update(variables - scope if block.scoped else variables)
+
+        def visit_block(block_name: str, depth: int, scope: FrozenSet[str] = frozenset()):
+            if (block_name, depth) in visited or depth >= len(definitions.get(block_name, ())):
+                return
+            visited.add((block_name, depth))
+            visit(definitions[block_name][depth].body, block_name, depth, scope)
+
+        def visit_macro(macro_name: str):
+            if macro_name in visited:
+                return
+            visited.add(macro_name)
+            visit([macros[macro_name]])
+
+        # Of the templates which extend another, only assignments outside of blocks run; the root template's
+        # output is rendered in full. Macros are analysed where they are called.
+        for ast in chain[:-1]:
+            visit([node for node in ast.body if isinstance(node, (nodes.Assign, nodes.AssignBlock))])
+        visit([node for node in chain[-1].body if not isinstance(node, (nodes.Extends, nodes.Macro))])
+        for block_name in blocks:
+            visit_block(block_name, 0)
+        return required - declared
+
+    def _inheritance_chain(self, template_name: str) -> List[nodes.Template]:
+        """
+        Returns the parsed template and the templates it extends, most derived first.
+        """
+        chain = []
+        seen = set()
+        while template_name is not None and template_name not in seen:
+            seen.add(template_name)
+            source = self.environment.loader.get_source(self.environment, template_name)[0]
+            ast = self.environment.parse(source, template_name)
+            chain.append(ast)
+            extends = next(ast.find_all(nodes.Extends), None)
+            if extends is not None and isinstance(extends.template, nodes.Const):
+                template_name = extends.template.value
+            else:
+                template_name = None
+        return chain
+
+    def _include_variables(self, template_name: str, ignore_missing: bool) -> Set[str]:
+        if template_name not in self._included:
+            self._included[template_name] = set()
+            try:
+                self._included[template_name] = self.required_variables(template_name)
+            except jinja2.TemplateNotFound:
+                if not ignore_missing:
+                    raise
+        return self._included[template_name]
+
+
+def _walk_body(body: list, scope: FrozenSet[str]) -> Iterator[Tuple[nodes.Node, FrozenSet[str]]]:
+    """
+    Yields each node in body and its descendants, along with the names assigned around it, without descending into
+    blocks, which are analysed on their own.
+    """
+    scope = set(scope)
+    for node in body:
+        yield from _walk(node, frozenset(scope))
+        if isinstance(node, (nodes.Assign, nodes.AssignBlock)):
+            scope.update(_target_names(node.target))
+
+
+def _walk(node: nodes.Node, scope: FrozenSet[str]) -> Iterator[Tuple[nodes.Node, FrozenSet[str]]]:
+    yield node, scope
+    if isinstance(node, nodes.Block):
+        return
+    if isinstance(node, nodes.For):
+        inner = scope | _target_names(node.target) | {'loop'}
+        yield from _walk(node.iter, scope)
+        if node.test is not None:
+            yield from _walk(node.test, inner)
+        yield from _walk_body(node.body, inner)
+        yield from _walk_body(node.else_, scope)
+    elif isinstance(node, nodes.With):
+        for value in node.values:
+            yield from _walk(value, scope)
+        inner = scope.union(*(_target_names(target) for target in node.targets))
+        yield from _walk_body(node.body, inner)
+    elif isinstance(node, (nodes.Macro, nodes.CallBlock)):
+        for child in node.defaults:
+            yield from _walk(child, scope)
+        if isinstance(node, nodes.CallBlock):
+            yield from _walk(node.call, scope)
+        inner = scope.union({'caller', 'varargs', 'kwargs'}, *(_target_names(arg) for arg in node.args))
+        yield from _walk_body(node.body, inner)
+    else:
+        for field in node.fields:
+            value = getattr(node, field)
+            if isinstance(value, list) and field in ('body', 'else_'):
+                yield from _walk_body(value, scope)
+            elif isinstance(value, list):
+                for child in value:
+                    if isinstance(child, nodes.Node):
+                        yield from _walk(child, scope)
+            elif isinstance(value, nodes.Node):
+                yield from _walk(value, scope)
+
+
+def _target_names(target: nodes.Node) -> FrozenSet[str]:
+    if isinstance(target, nodes.Name):
+        return frozenset([target.name])
+    return frozenset(name.name for name in target.find_all(nodes.Name))
+
+
+def _top_level_names(ast: nodes.Template) -> Set[str]:
+    """
+    Returns the names a template sets outside of any block, which its blocks can then use.
+    """
+    names = set()
+    for node in ast.body:
+        if isinstance(node, (nodes.Assign, nodes.AssignBlock)):
+            names.update(_target_names(node.target))
+        elif isinstance(node, nodes.Import):
+            names.add(node.target)
+        elif isinstance(node, nodes.FromImport):
+            names.update(name if isinstance(name, str) else name[1] for name in node.names)
+        elif isinstance(node, nodes.Macro):
+            names.add(node.name)
+    return names
+
+
+class _Preparer(NodeTransformer):
+    """
+    Removes blocks, which are analysed on their own, and the uses of variables which are guarded by the defined
+    test or the default filter, so only unguarded uses are left to count as required.
+    """
+    def __init__(self):
+        self.guarded = frozenset()
+
+    def visit_Block(self, node):
+        return None
+
+    def visit_Name(self, node):
+        if node.ctx == 'load' and node.name in self.guarded:
+            return nodes.Const(None, lineno=node.lineno)
+        return node
+
+    def visit_Test(self, node):
+        if node.name in _optional_tests and isinstance(node.node, nodes.Name):
+            node.node = nodes.Const(None, lineno=node.lineno)
+        return self.generic_visit(node)
+
+    def visit_Filter(self, node):
+        if node.name in _optional_filters and isinstance(node.node, nodes.Name):
+            node.node = nodes.Const(None, lineno=node.lineno)
+        return self.generic_visit(node)
+
+    def visit_If(self, node):
+        defined, undefined = _guards(node.test)
+        node.test = self.visit(node.test)
+        node.body = self._visit_guarded(node.body, defined)
+        node.elif_ = [self.visit(child) for child in node.elif_]
+        node.else_ = self._visit_guarded(node.else_, undefined)
+        return node
+
+    def _visit_guarded(self, body: list, names: FrozenSet[str]) -> list:
+        guarded, self.guarded = self.guarded, self.guarded | names
+        try:
+            return [child for child in (self.visit(node) for node in body) if child is not None]
+        finally:
+            self.guarded = guarded
+
+
+def _guards(test: nodes.Node) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Returns the names an if statement's test checks are defined for its body, and undefined for its else branch.
+    """
+    if isinstance(test, nodes.Test) and test.name in _optional_tests and isinstance(test.node, nodes.Name):
+        names = frozenset([test.node.name])
+        return (names, frozenset()) if test.name == 'defined' else (frozenset(), names)
+    if isinstance(test, nodes.Not):
+        defined, undefined = _guards(test.node)
+        return undefined, defined
+    if isinstance(test, nodes.And):
+        return _guards(test.left)[0] | _guards(test.right)[0], frozenset()
+    if isinstance(test, nodes.Or):
+        return frozenset(), _guards(test.left)[1] | _guards(test.right)[1]
+    return frozenset(), frozenset()
+
+
+def _prepare(environment: jinja2.Environment, body: list) -> list:
+    """
+    Returns a copy of body prepared by _Preparer for finding the variables it requires.
+    """
+    preparer = _Preparer()
+    prepared = []
+    # Nodes refer to the environment they were parsed in, which is shared rather than copied.
+    for node in copy.deepcopy(body, {id(environment): environment}):
+        node = preparer.visit(node)
+        if node is not None:
+            prepared.append(node)
+    return prepared
@@ -1,13 +1,35 @@
+import email
+import email.policy
 import html
+import json
 import os
+import smtplib
+import socket
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import webbrowser
-from unittest import TestCase
-from unittest.mock import Mock, patch
+from unittest import IsolatedAsyncioTestCase, TestCase, skipUnless
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+import jinja2
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
 
 import templatemail
 import templatemail.engines.mailgun
 import templatemail.engines.smtp
+import templatemail.outbox
 
 _dir_path = os.path.dirname(os.path.realpath(__file__))
 _test_template_dir = os.path.join(_dir_path, 'test_templates')
@@ -18,6 +40,16 @@ open_results_in_browser = os.environ.get('TEST_TEMPLATEMAIL_IN_BROWSER', 'False'
     'true', '1', 'yes', 't', 'y')
 
 
+def _smtp_server():
+    """
+    Returns a mock smtplib.SMTP which accepts every command.
+    """
+    server = Mock()
+    for command in ('mail', 'rcpt', 'data', 'noop'):
+        getattr(server, command).return_value = (250, b'OK')
+    return server
+
+
 class TestTemplateMail(TestCase):
     def _open_content_rendering_in_browser(self, content):
         if open_results_in_browser:
@@ -37,6 +69,254 @@ class TestTemplateMail(TestCase):
         self.assertEqual(content.html_body, "HTML stuff")
         self.assertEqual(content.text_body, "Text stuff")
 
+    def test_render_block_self_reference(self):
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+        content = mailer.render(
+            'self_reference_template.html',
+            name='Joe'
+        )
+        self.assertEqual(content.subject, "Subject for Joe")
+        self.assertEqual(content.html_body, "<h1>Subject for Joe</h1>")
+        self.assertEqual(content.text_body, "Subject for Joe")
+
+    def test_render_missing_block(self):
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+        self.assertRaises(
+            jinja2.UndefinedError,
+            mailer.render,
+            'missing_block_template.html'
+        )
+
+    def test_warm_up(self):
+        with tempfile.TemporaryDirectory() as bytecode_cache_dir:
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir],
+                                               bytecode_cache_dir=bytecode_cache_dir)
+            template_names = mailer.warm_up(extensions=['html'])
+            self.assertIn('simple_template.html', template_names)
+            self.assertIn('mailgun-transactional/billing.html', template_names)
+            self.assertEqual(len(os.listdir(bytecode_cache_dir)), len(template_names))
+
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir],
+                                               bytecode_cache_dir=bytecode_cache_dir)
+            with patch.object(mailer.template_environment, 'compile', side_effect=AssertionError) as compile:
+                content = mailer.render('simple_template.html')
+            compile.assert_not_called()
+            self.assertEqual(content.subject, "My Subject")
+
+    def test_render_cache(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            layout_path = os.path.join(template_dir, 'layout.html')
+            with open(layout_path, 'w') as f:
+                f.write('{% block subject %}{% endblock %}{% block text_body %}{% endblock %}'
+                        '{% block html_body %}{% endblock %}')
+            with open(os.path.join(template_dir, 'notice.html'), 'w') as f:
+                f.write('{% extends "layout.html" %}{% block subject %}Notice {{ number }}{% endblock %}'
+                        '{% block text_body %}{{ lines|join(",") }}{% endblock %}'
+                        '{% block html_body %}{{ lines|join("<br>") }}{% endblock %}')
+
+            render_cache = templatemail.RenderCache(max_size=2)
+            mailer = templatemail.TemplateMail(template_dirs=[template_dir], render_cache=render_cache)
+
+            content = mailer.render('notice.html', number=1, lines=['a', 'b'])
+            self.assertIs(mailer.render('notice.html', number=1, lines=['a', 'b']), content)
+            self.assertEqual(mailer.render('notice.html', number=True, lines=['a', 'b']).subject, 'Notice True')
+            mailer.render('notice.html', number=1, lines=iter(['a', 'b']))
+            self.assertEqual(render_cache.stats, templatemail.RenderCacheStats(
+                hits=1, misses=2, uncacheable=1, evictions=0, size=2))
+
+            # Changing a parent template invalidates renderings of its children
+            with open(layout_path, 'w') as f:
+                f.write('{% block subject %}{% endblock %}!{% block text_body %}{% endblock %}'
+                        '{% block html_body %}{% endblock %}')
+            mtime = os.path.getmtime(layout_path) + 10
+            os.utime(layout_path, (mtime, mtime))
+            self.assertIsNot(mailer.render('notice.html', number=1, lines=['a', 'b']), content)
+            self.assertEqual(render_cache.stats.evictions, 1)
+
+    def test_static_include(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            style_path = os.path.join(template_dir, 'style.html')
+            with open(style_path, 'w') as f:
+                f.write('<style>p {}</style>\n')
+            with open(os.path.join(template_dir, 'notice.html'), 'w') as f:
+                f.write('{% block subject %}Notice{% endblock %}{% block text_body %}{% endblock %}'
+                        '{% block html_body %}{% include "style.html" %}{{ body }}{% endblock %}')
+
+            mailer = templatemail.TemplateMail(template_dirs=[template_dir])
+            mailer.render('notice.html', body='a')
+            with patch.object(mailer.template_environment, 'get_template',
+                              wraps=mailer.template_environment.get_template) as get_template:
+                self.assertEqual(mailer.render('notice.html', body='b').html_body, '<style>p {}</style>b')
+            self.assertNotIn('style.html', [call.args[0] for call in get_template.call_args_list])
+
+            # Changing the included template recompiles the template including it
+            with open(style_path, 'w') as f:
+                f.write('<style>div {}</style>')
+            mtime = os.path.getmtime(style_path) + 10
+            os.utime(style_path, (mtime, mtime))
+            self.assertEqual(mailer.render('notice.html', body='c').html_body, '<style>div {}</style>c')
+
+    def test_tenants(self):
+        with tempfile.TemporaryDirectory() as tenant_template_root:
+            os.mkdir(os.path.join(tenant_template_root, 'acme'))
+            with open(os.path.join(tenant_template_root, 'acme', 'simple_template.html'), 'w') as f:
+                f.write('{% extends "base.html" %}{% block subject %}Acme Subject{% endblock %}')
+
+            render_cache = templatemail.RenderCache()
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], render_cache=render_cache,
+                                               tenant_template_root=tenant_template_root, max_tenants=1)
+            acme = mailer.for_tenant('acme')
+            self.assertIs(mailer.for_tenant('acme'), acme)
+            self.assertIs(mailer.for_tenant('other'), mailer)
+            self.assertIsNot(mailer.for_tenant('acme'), acme)
+            with self.assertRaises(ValueError):
+                mailer.for_tenant('../acme')
+
+            self.assertEqual(mailer.render('simple_template.html').subject, 'My Subject')
+            self.assertEqual(acme.render('simple_template.html').subject, 'Acme Subject')
+            self.assertEqual(mailer.for_tenant('other').render('simple_template.html').subject, 'My Subject')
+
+            # Templates shared between tenants are only compiled once
+            context = dict(subject='Alert', signature='--The Team', action_link='http://localhost:8080/upgrade',
+                           action_text='Upgrade Now', warning_text='Warning', details='Details', footer='Footer')
+            with patch.object(jinja2.Environment, 'compile', autospec=True,
+                              side_effect=jinja2.Environment.compile) as compile:
+                mailer.render('mailgun-transactional/alert.html', **context)
+                mailer.for_tenant('acme').render('mailgun-transactional/alert.html', **context)
+            self.assertEqual(compile.call_count, 1)
+
+            # Tenants have their own reloader, unaffected by the shared mailer's
+            acme = mailer.for_tenant('acme')
+            self.assertIs(acme.for_tenant('acme'), acme)
+            acme.start_reloading(interval=0.01)
+            mailer.start_reloading(interval=0.01)
+            mailer.stop_reloading()
+            self.assertTrue(acme._reloader.is_alive())
+            acme.stop_reloading()
+            acme.start_reloading(interval=0.01)
+            self.assertTrue(acme._reloader.is_alive())
+            acme.stop_reloading()
+
+    def test_tenant_caches_bounded(self):
+        with tempfile.TemporaryDirectory() as tenant_template_root:
+            tenants = [f'tenant{i}' for i in range(6)]
+            for tenant in tenants:
+                os.mkdir(os.path.join(tenant_template_root, tenant))
+                with open(os.path.join(tenant_template_root, tenant, 'simple_template.html'), 'w') as f:
+                    f.write(f'{{% extends "base.html" %}}{{% block subject %}}{tenant}{{% endblock %}}')
+
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], max_tenants=2,
+                                               tenant_template_root=tenant_template_root,
+                                               compiled_template_cache_size=4)
+            for tenant in tenants:
+                self.assertEqual(mailer.for_tenant(tenant).render('simple_template.html').subject, tenant)
+            self.assertEqual(len(mailer._tenants), 2)
+            self.assertLessEqual(len(mailer._get_bytecode_cache()), 4)
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            notice_path = os.path.join(template_dir, 'notice.html')
+            with open(notice_path, 'w') as f:
+                f.write('{% extends "base.html" %}{% block subject %}Notice{% endblock %}')
+
+            render_cache = templatemail.RenderCache()
+            mailer = templatemail.TemplateMail(template_dirs=[template_dir], render_cache=render_cache,
+                                               auto_reload=False)
+            self.assertEqual(mailer.render('notice.html').subject, 'Notice')
+            self.assertEqual(mailer.reload(), [])
+
+            with open(notice_path, 'w') as f:
+                f.write('{% extends "base.html" %}{% block subject %}Changed Notice{% endblock %}')
+            mtime = os.path.getmtime(notice_path) + 10
+            os.utime(notice_path, (mtime, mtime))
+            with patch('os.path.getmtime', side_effect=AssertionError) as getmtime:
+                self.assertEqual(mailer.render('notice.html').subject, 'Notice')
+            getmtime.assert_not_called()
+
+            with patch.object(jinja2.Environment, 'compile', autospec=True,
+                              side_effect=jinja2.Environment.compile) as compile:
+                self.assertEqual(mailer.reload(), ['notice.html'])
+            self.assertEqual(compile.call_count, 1)
+            self.assertEqual(mailer.render('notice.html').subject, 'Changed Notice')
+
+    def test_lazy_imports(self):
+        # Importing templatemail, or creating a TemplateMail, does not import Jinja or the engines' dependencies.
+        script = ('import sys, templatemail, templatemail.engines.mailgun; templatemail.TemplateMail(); '
+                  'print(sorted({"jinja2", "requests", "asyncio"} & set(sys.modules)))')
+        output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(_dir_path), capture_output=True,
+                                text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_validate(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            with open(os.path.join(template_dir, 'layout.html'), 'w') as f:
+                f.write('{% block subject %}{{ company }}{% endblock %}{% block text_body %}{% endblock %}'
+                        '{% block html_body %}{{ unused_in_child }}{% endblock %}{% block footer %}{% endblock %}')
+            with open(os.path.join(template_dir, 'footer.html'), 'w') as f:
+                f.write('{{ address }} {{ item }}')
+            with open(os.path.join(template_dir, 'notice.html'), 'w') as f:
+                f.write('{% extends "layout.html" %}{% set greeting = "Hello" %}'
+                        '{% block subject %}{{ super() }}: {{ greeting }} {{ name }}{% endblock %}'
+                        '{% block text_body %}{% for item in items %}{% include "footer.html" %}{% endfor %}'
+                        '{{ self.footer() }}{% endblock %}'
+                        '{% block html_body %}{% if note is defined %}{{ note }}{% endif %}{{ title|default("") }}'
+                        '{% endblock %}')
+
+            mailer = templatemail.TemplateMail(template_dirs=[template_dir])
+            self.assertEqual(mailer.required_variables('notice.html'), {'company', 'name', 'items', 'address'})
+
+            context = dict(company='Acme', name='Ann', items=[1], address='1 Road')
+            self.assertEqual(mailer.validate('notice.html', [context, dict(context, name='Bob', note='!'),
+                                                             dict(company='Acme', items=[]), dict(context, name=None)]),
+                             [templatemail.ValidationFailure(2, {'name', 'address'})])
+            self.assertEqual(mailer.validate('notice.html', [context, dict(context, name=None)], none_is_missing=True),
+                             [templatemail.ValidationFailure(1, {'name'})])
+            mailer.render('notice.html', **context)
+
+            columns = dict(company=['Acme', 'Acme', 'Acme'], name=['Ann', None, 'Bob'], items=[[], [], None],
+                           address=['1 Road', '2 Road', '3 Road'], note=[None, None, None])
+            self.assertEqual(mailer.validate_columns('notice.html', columns), [])
+            self.assertEqual(mailer.validate_columns('notice.html', columns, none_is_missing=True),
+                             [templatemail.ValidationFailure(1, {'name'}),
+                              templatemail.ValidationFailure(2, {'items'})])
+            del columns['company']
+            self.assertEqual([failure.missing for failure in mailer.validate_columns('notice.html', columns)],
+                             [{'company'}, {'company'}, {'company'}])
+            self.assertEqual([failure.missing for failure in mailer.validate_columns('notice.html', columns,
+                                                                                     none_is_missing=True)],
+                             [{'company'}, {'company', 'name'}, {'company', 'items'}])
+            with self.assertRaises(ValueError):
+                mailer.validate_columns('notice.html', dict(name=['Ann'], items=[]))
+
+            # A variable is only optional if every use of it is guarded
+            with open(os.path.join(template_dir, 'guarded.html'), 'w') as f:
+                f.write('{% extends "layout.html" %}{% block subject %}{{ title|default("") }}{% endblock %}'
+                        '{% block text_body %}{{ title }}{% endblock %}'
+                        '{% block html_body %}{% if note is defined %}{{ note }}{% else %}{{ fallback }}{% endif %}'
+                        '{% endblock %}')
+            self.assertEqual(mailer.required_variables('guarded.html'), {'title', 'fallback'})
+
+            # Macros are analysed where they are called
+            with open(os.path.join(template_dir, 'macros.html'), 'w') as f:
+                f.write('{% extends "layout.html" %}{% macro greet(person) %}{{ greeting }} {{ person }}{% endmacro %}'
+                        '{% macro unused() %}{{ unused_variable }}{% endmacro %}'
+                        '{% block subject %}{{ greet(name) }}{% endblock %}{% block html_body %}{% endblock %}')
+            self.assertEqual(mailer.required_variables('macros.html'), {'greeting', 'name'})
+
+            # An include only sees the variables set around it, not those set elsewhere
+            with open(os.path.join(template_dir, 'include_scope.html'), 'w') as f:
+                f.write('{% extends "layout.html" %}{% block subject %}{% include "footer.html" %}{% endblock %}'
+                        '{% block text_body %}{% set address = "1 Road" %}{% set item = 1 %}{% endblock %}'
+                        '{% block html_body %}{% endblock %}')
+            self.assertEqual(mailer.required_variables('include_scope.html'), {'address', 'item'})
+            with self.assertRaises(jinja2.UndefinedError):
+                mailer.render('include_scope.html')
+
+    def test_render_partial_deprecated(self):
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(mailer._render_partial('simple_template.html', 'subject'), 'My Subject')
+
     def test_render_action_email(self):
         mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
         content = mailer.render(
@@ -115,14 +395,210 @@ class TestTemplateMail(TestCase):
             template_name='simple_template.html'
         )
 
+    def test_send_many(self):
+        engine = Mock()
+        engine.send_simple_message.side_effect = [None, templatemail.DeliveryNotMade(details='Rejected'), None]
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine)
+
+        recipients = ((f'user{i}@example.com', {'name': f'User {i}'}) for i in range(3))
+        results = mailer.send_many(
+            template_name='self_reference_template.html',
+            from_address='from@example.com',
+            recipients=recipients,
+            max_pending=2
+        )
+        self.assertEqual([result.to_addresses for result in results],
+                         [['user0@example.com'], ['user1@example.com'], ['user2@example.com']])
+        self.assertEqual([result.delivered for result in results], [True, False, True])
+        self.assertEqual(results[1].error.details, 'Rejected')
+        self.assertEqual([call.kwargs['subject'] for call in engine.send_simple_message.call_args_list],
+                         ['Subject for User 0', 'Subject for User 1', 'Subject for User 2'])
+
+    def test_outbox(self):
+        attempts = {}
+
+        def send_simple_message(to_addresses, **message):
+            to_address = to_addresses[0]
+            attempts[to_address] = attempts.get(to_address, 0) + 1
+            if to_address == 'user1@example.com' and attempts[to_address] == 1:
+                raise templatemail.DeliveryNotMade(details='Try again')
+            if to_address == 'user2@example.com':
+                raise templatemail.DeliveryNotMade(details='Rejected')
+
+        engine = Mock()
+        engine.send_simple_message.side_effect = send_simple_message
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+
+        with tempfile.TemporaryDirectory() as outbox_dir:
+            outbox_path = os.path.join(outbox_dir, 'outbox.sqlite')
+            recipients = [(f'user{i}@example.com', {'name': f'User {i}'}) for i in range(3)]
+            with templatemail.outbox.Outbox(outbox_path, batch_size=2, max_attempts=3, backoff=0) as outbox:
+                self.assertEqual(mailer.queue_many('self_reference_template.html', 'from@example.com', recipients[:2],
+                                                   outbox), 2)
+            # A send run again after being interrupted only adds the rest
+            with templatemail.outbox.Outbox(outbox_path, batch_size=2, max_attempts=3, backoff=0) as outbox:
+                self.assertEqual(mailer.queue_many('self_reference_template.html', 'from@example.com', recipients,
+                                                   outbox), 1)
+                self.assertEqual(outbox.drain(engine, workers=2),
+                                 templatemail.outbox.OutboxStats(pending=0, delivered=2, failed=1))
+
+            self.assertEqual(attempts, {'user0@example.com': 1, 'user1@example.com': 2, 'user2@example.com': 3})
+            with templatemail.outbox.Outbox(outbox_path) as outbox:
+                self.assertEqual(outbox.drain(engine),
+                                 templatemail.outbox.OutboxStats(pending=0, delivered=2, failed=1))
+            self.assertEqual(engine.send_simple_message.call_count, 6)
+
+    def test_outbox_claims(self):
+        engine = Mock()
+        engine.send_simple_message.side_effect = [ConnectionError('Connection reset'), None, None]
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+
+        with tempfile.TemporaryDirectory() as outbox_dir:
+            outbox_path = os.path.join(outbox_dir, 'outbox.sqlite')
+            recipients = [(f'user{i}@example.com', {'name': f'User {i}'}) for i in range(2)]
+            with templatemail.outbox.Outbox(outbox_path, backoff=0) as first, \
+                    templatemail.outbox.Outbox(outbox_path, backoff=0) as second:
+                mailer.queue_many('self_reference_template.html', 'from@example.com', recipients, first)
+                first.flush()
+                # Messages claimed by one drain are not sent by another
+                self.assertEqual(len(first._due_messages()), 2)
+                self.assertEqual(second._due_messages(), [])
+                self.assertEqual(second.drain(engine),
+                                 templatemail.outbox.OutboxStats(pending=2, delivered=0, failed=0))
+                engine.send_simple_message.assert_not_called()
+
+            # Once the first drain's claim expires, eg. because it died, another drain sends its messages, and retries
+            # connection errors
+            with templatemail.outbox.Outbox(outbox_path, backoff=0) as outbox, \
+                    patch('templatemail.outbox.time.time', return_value=time.time() + 601):
+                self.assertEqual(outbox.drain(engine),
+                                 templatemail.outbox.OutboxStats(pending=0, delivered=2, failed=0))
+            self.assertEqual(engine.send_simple_message.call_count, 3)
+
+    def test_send_many_errors(self):
+        engine = self._get_smtp_engine()
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine)
+        recipients = [('user0@example.com', {'name': 'User 0'}), ('user1@example.com', {}),
+                      ('user2@example.com', {'name': 'User 2'}), ('user3@example.com', {'name': 'User 3'})]
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            smtp.return_value.rcpt.side_effect = lambda to_address: \
+                (550, b'No such user') if to_address == 'user2@example.com' else (250, b'OK')
+            results = mailer.send_many('self_reference_template.html', 'from@example.com', recipients)
+
+        self.assertEqual([result.delivered for result in results], [True, False, False, True])
+        self.assertIsInstance(results[1].error, jinja2.UndefinedError)
+        self.assertIsInstance(results[2].error, templatemail.engines.smtp.SMTPError)
+        self.assertIsInstance(results[2].error.__cause__, smtplib.SMTPRecipientsRefused)
+
+    def test_mailgun_batch_sending(self):
+        engine = templatemail.engines.mailgun.MailgunDeliveryEngine(api_key='foobar', domain_name='spam.eggs')
+        engine._requests.post = Mock(return_value=Mock(status_code=200))
+
+        recipient_variables = {f'user{i}@example.com': {'name': f'User {i}'} for i in range(5)}
+        engine.send_batch_message(from_address='from@example.com',
+                                  recipient_variables=recipient_variables,
+                                  subject='Hello %recipient.name%',
+                                  text_body='TEXT Body',
+                                  batch_size=2)
+        self.assertEqual(engine._requests.post.call_count, 3)
+        data = engine._requests.post.call_args_list[2].kwargs['data']
+        self.assertEqual(data['to'], ['user4@example.com'])
+        self.assertEqual(json.loads(data['recipient-variables']), {'user4@example.com': {'name': 'User 4'}})
+
+        engine._requests.post = Mock(return_value=Mock(status_code=400))
+        self.assertRaises(
+            templatemail.DeliveryNotMade,
+            engine.send_batch_message,
+            from_address='from@example.com',
+            recipient_variables=recipient_variables,
+            subject='Hello %recipient.name%',
+            text_body='TEXT Body'
+        )
+
+    def test_delivery_queue(self):
+        def send_simple_message(to_addresses, **kwargs):
+            if to_addresses == ['bad@example.com']:
+                raise templatemail.DeliveryNotMade(details='Rejected')
+
+        engine = Mock()
+        engine.send_simple_message.side_effect = send_simple_message
+        with templatemail.DeliveryQueue(workers=2, max_size=1, max_concurrency_per_engine=1) as delivery_queue:
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine,
+                                               delivery_queue=delivery_queue)
+            futures = [mailer.send_email(to_addresses=[to_address],
+                                         from_address='from@example.com',
+                                         template_name='simple_template.html')
+                       for to_address in ('test@example.com', 'bad@example.com')]
+            delivery_queue.flush()
+
+        self.assertIsNone(futures[0].result())
+        self.assertIsInstance(futures[1].exception(), templatemail.DeliveryNotMade)
+        self.assertEqual(engine.send_simple_message.call_count, 2)
+        self.assertRaises(RuntimeError, delivery_queue.submit, engine)
+
+    def test_delivery_queue_shutdown_during_submit(self):
+        release = threading.Event()
+        engine = Mock()
+        engine.send_simple_message.side_effect = lambda **message: release.wait(5)
+        delivery_queue = templatemail.DeliveryQueue(workers=1, max_size=1)
+        futures = [delivery_queue.submit(engine, to_addresses=[f'user{i}@example.com']) for i in range(2)]
+
+        # The third submit blocks on the full queue while shutdown is called.
+        submitter = threading.Thread(target=lambda: futures.append(
+            delivery_queue.submit(engine, to_addresses=['user2@example.com'])))
+        submitter.start()
+        while delivery_queue._submitting == 0:
+            pass
+        shutdown = threading.Thread(target=delivery_queue.shutdown)
+        shutdown.start()
+        release.set()
+        submitter.join(5)
+        shutdown.join(5)
+
+        self.assertFalse(shutdown.is_alive())
+        self.assertEqual([future.result(timeout=5) for future in futures], [None, None, None])
+
+    def test_render_many(self):
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+        contexts = ({'name': f'User {i}'} for i in range(25))
+        subjects = [content.subject for content in mailer.render_many('self_reference_template.html', contexts,
+                                                                      processes=2, chunk_size=4)]
+        self.assertEqual(subjects, [f'Subject for User {i}' for i in range(25)])
+
+    def test_worker_configuration(self):
+        with tempfile.TemporaryDirectory() as tenant_template_root:
+            os.mkdir(os.path.join(tenant_template_root, 'acme'))
+            mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], max_tenants=3, auto_reload=False,
+                                               tenant_template_root=tenant_template_root,
+                                               compiled_template_cache_size=7)
+            for source in (mailer, mailer.for_tenant('acme')):
+                worker = source._worker_factory()(**source._worker_kwargs())
+                for option in ('template_dirs', 'bytecode_cache_dir', 'tenant_template_root', 'max_tenants',
+                               'auto_reload', 'compiled_template_cache_size', 'tenant'):
+                    self.assertEqual(getattr(worker, option), getattr(source, option))
+
+    def test_send_many_in_processes(self):
+        engine = Mock()
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine)
+        results = mailer.send_many(
+            template_name='self_reference_template.html',
+            from_address='from@example.com',
+            recipients=((f'user{i}@example.com', {'name': f'User {i}'}) for i in range(5)),
+            processes=2,
+            delivery_threads=2
+        )
+        self.assertEqual([result.to_addresses for result in results], [[f'user{i}@example.com'] for i in range(5)])
+        self.assertEqual(sorted(call.kwargs['subject'] for call in engine.send_simple_message.call_args_list),
+                         [f'Subject for User {i}' for i in range(5)])
+
     def test_smtp_sending(self):
         for security in (templatemail.engines.smtp.SMTPSecurity.NONE, templatemail.engines.smtp.SMTPSecurity.START_TLS,
                          templatemail.engines.smtp.SMTPSecurity.SSL):
             engine = self._get_smtp_engine(security=security)
 
             # TODO: Make this really test something meaningful
-            with patch('templatemail.engines.smtp.smtplib.SMTP_SSL') as smtp_ssl:
-                with patch('templatemail.engines.smtp.smtplib.SMTP') as smtp:
+            with patch('templatemail.engines.smtp.smtplib.SMTP_SSL', return_value=_smtp_server()):
+                with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()):
                     engine.send_simple_message(from_address='from@example.com',
                                                to_addresses=['to@example.com'],
                                                subject='Test',
@@ -139,6 +615,161 @@ class TestTemplateMail(TestCase):
                                                html_body='HTML Body')
 
 
+    def test_smtp_connection_closed_without_pool(self):
+        engine = self._get_smtp_engine()
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            for _ in range(2):
+                engine.send_simple_message(from_address='from@example.com',
+                                           to_addresses=['to@example.com'],
+                                           subject='Test',
+                                           text_body='TEXT Body')
+            self.assertEqual(smtp.call_count, 2)
+            self.assertEqual(smtp.return_value.quit.call_count, 2)
+
+    def test_smtp_connection_pool(self):
+        engine = self._get_smtp_engine(pool_size=1, max_messages_per_connection=3)
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            for _ in range(4):
+                engine.send_simple_message(from_address='from@example.com',
+                                           to_addresses=['to@example.com'],
+                                           subject='Test',
+                                           text_body='TEXT Body')
+            self.assertEqual(smtp.call_count, 2)
+            self.assertEqual(smtp.return_value.data.call_count, 4)
+            self.assertEqual(smtp.return_value.quit.call_count, 1)
+
+            engine.close()
+            self.assertEqual(smtp.return_value.close.call_count, 2)
+
+    def test_smtp_connection_pool_reconnect(self):
+        engine = self._get_smtp_engine(pool_size=1)
+        with patch('templatemail.engines.smtp.smtplib.SMTP') as smtp:
+            stale_server, fresh_server = _smtp_server(), _smtp_server()
+            stale_server.mail.side_effect = [(250, b'OK'), smtplib.SMTPServerDisconnected]
+            fresh_server.data.side_effect = [(250, b'OK'), smtplib.SMTPServerDisconnected]
+            smtp.side_effect = [stale_server, fresh_server]
+            for _ in range(2):
+                engine.send_simple_message(from_address='from@example.com',
+                                           to_addresses=['to@example.com'],
+                                           subject='Test',
+                                           text_body='TEXT Body')
+            # The pooled connection dropped before the server accepted anything, so the message was sent again
+            stale_server.close.assert_called_once()
+            stale_server.data.assert_called_once()
+            fresh_server.data.assert_called_once()
+            stale_server.noop.assert_not_called()
+
+            # A message is not sent again after the connection drops during DATA, as it may have been accepted
+            self.assertRaises(templatemail.engines.smtp.SMTPError, engine.send_simple_message,
+                              from_address='from@example.com', to_addresses=['to@example.com'], subject='Test',
+                              text_body='TEXT Body')
+            self.assertEqual(fresh_server.data.call_count, 2)
+            fresh_server.close.assert_called_once()
+            self.assertEqual(smtp.call_count, 2)
+
+    def test_smtp_connection_setup_failure(self):
+        engine = self._get_smtp_engine(security=templatemail.engines.smtp.SMTPSecurity.START_TLS)
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            smtp.return_value.starttls.side_effect = smtplib.SMTPNotSupportedError
+            self.assertRaises(templatemail.engines.smtp.SMTPError, engine.send_simple_message,
+                              from_address='from@example.com', to_addresses=['to@example.com'], subject='Test',
+                              text_body='TEXT Body')
+            smtp.return_value.close.assert_called_once()
+
+    def test_smtp_send_to_many(self):
+        engine = self._get_smtp_engine(pool_size=1)
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            engine.send_to_many(from_address='from@example.com',
+                                recipients=[['one@example.com'], ['two@example.com', 'three@example.com']],
+                                subject='Test',
+                                text_body='TEXT Body',
+                                html_body='HTML Body')
+            self.assertEqual(smtp.call_count, 1)
+
+            self.assertEqual([call.args[0] for call in smtp.return_value.rcpt.call_args_list],
+                             ['one@example.com', 'two@example.com', 'three@example.com'])
+            messages = [email.message_from_bytes(call.args[0], policy=email.policy.default)
+                        for call in smtp.return_value.data.call_args_list]
+            self.assertEqual([message['To'] for message in messages],
+                             ['one@example.com', 'two@example.com, three@example.com'])
+            self.assertEqual(messages[1].get_body(('plain',)).get_content().strip(), 'TEXT Body')
+            self.assertEqual(messages[1].get_body(('html',)).get_content().strip(), 'HTML Body')
+
+            smtp.return_value.data.side_effect = [(250, b'OK'), (554, b'Rejected')]
+            with self.assertRaises(templatemail.engines.smtp.SMTPError) as raised:
+                engine.send_to_many(from_address='from@example.com',
+                                    recipients=[['one@example.com'], ['two@example.com'], ['three@example.com']],
+                                    subject='Test',
+                                    text_body='TEXT Body')
+            self.assertIn('(1 deliveries were already sent)', raised.exception.details)
+            with self.assertRaises(ValueError):
+                engine.send_to_many(from_address='from@example.com', recipients=[['one@example.com']],
+                                    subject='Test', text_body='TEXT Body', headers={'to': 'other@example.com'})
+
+    def test_metrics(self):
+        metrics = Mock(spec=templatemail.MetricsSink)
+        engine = self._get_smtp_engine(metrics=metrics)
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine, metrics=metrics)
+        with patch('templatemail.engines.smtp.smtplib.SMTP', return_value=_smtp_server()) as smtp:
+            smtp.return_value.data.return_value = (554, b'Rejected')
+            self.assertRaises(
+                templatemail.engines.smtp.SMTPError,
+                mailer.send_email,
+                to_addresses=['test@example.com'],
+                from_address='from@example.com',
+                template_name='simple_template.html'
+            )
+
+        timings = {(call.args[0], tuple(sorted(call.args[2].items()))) for call in metrics.timing.call_args_list}
+        self.assertEqual(timings, {
+            ('render', (('template', 'simple_template.html'),)),
+            ('render.lookup', (('template', 'simple_template.html'),)),
+            ('render.block', (('block', 'subject'), ('template', 'simple_template.html'))),
+            ('render.block', (('block', 'text_body'), ('template', 'simple_template.html'))),
+            ('render.block', (('block', 'html_body'), ('template', 'simple_template.html'))),
+            ('delivery', (('engine', 'SMTPDeliveryEngine'), ('template', 'simple_template.html'))),
+            ('smtp.build_message', (('engine', 'SMTPDeliveryEngine'),)),
+            ('smtp.connect', (('engine', 'SMTPDeliveryEngine'),)),
+            ('smtp.transfer', (('engine', 'SMTPDeliveryEngine'),)),
+        })
+        metrics.increment.assert_any_call('smtp.transfer.errors',
+                                          {'engine': 'SMTPDeliveryEngine', 'error': 'SMTPDataError'})
+        metrics.histogram.assert_any_call('render.block_size', len('My Subject'),
+                                          {'template': 'simple_template.html', 'block': 'subject'})
+
+    def test_background_delivery_metrics(self):
+        metrics = Mock(spec=templatemail.MetricsSink)
+        engine = Mock(spec=templatemail.engines.Engine)
+        engine.send_simple_message.side_effect = [None, templatemail.DeliveryNotMade(details='Rejected')]
+        tags = {'template': 'simple_template.html', 'engine': 'Mock'}
+
+        delivery_queue = templatemail.DeliveryQueue(workers=1)
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine,
+                                           delivery_queue=delivery_queue, metrics=metrics)
+        mailer.send_email(to_addresses=['test@example.com'], from_address='from@example.com',
+                          template_name='simple_template.html').result()
+        delivery_queue.shutdown()
+
+        with tempfile.TemporaryDirectory() as outbox_dir:
+            with templatemail.outbox.Outbox(os.path.join(outbox_dir, 'outbox.sqlite'), max_attempts=1,
+                                            metrics=metrics) as outbox:
+                mailer.queue_many('simple_template.html', 'from@example.com', [(['test@example.com'], {})], outbox)
+                outbox.drain(engine)
+        metrics.increment.assert_any_call('delivery.errors', dict(tags, error='DeliveryNotMade'))
+        timings = [(call.args[0], call.args[2]) for call in metrics.timing.call_args_list]
+        self.assertEqual(timings.count(('delivery', tags)), 2)
+
+    def test_statsd_metrics_sink(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server:
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(5)
+            metrics = templatemail.StatsdMetricsSink(port=server.getsockname()[1], host='127.0.0.1')
+            metrics.timing('render', 0.0125, {'template': 'welcome.html'})
+            metrics.increment('delivery.errors', {'error': 'DeliveryNotMade'})
+            metrics.close()
+            self.assertEqual(server.recv(1024), b'templatemail.render:12.500|ms|#template:welcome.html')
+            self.assertEqual(server.recv(1024), b'templatemail.delivery.errors:1|c|#error:DeliveryNotMade')
+
     def test_delivery_engine_not_installed(self):
         """
         Tests to make sure DeliveryEngineNotInstalled is raised
@@ -178,12 +809,102 @@ class TestTemplateMail(TestCase):
             footer='Sent by the Acme Corporation'
         )
 
-    def _get_smtp_engine(self, security=templatemail.engines.smtp.SMTPSecurity.NONE):
+    def _get_smtp_engine(self, security=templatemail.engines.smtp.SMTPSecurity.NONE, **kwargs):
         engine = templatemail.engines.smtp.SMTPDeliveryEngine(
             host='localhost',
             port=25,
             security=security,
             username='test',
-            password='test'
+            password='test',
+            **kwargs
         )
         return engine
+
+
+class TestAsyncTemplateMail(IsolatedAsyncioTestCase):
+    async def test_render_async(self):
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir])
+        content = await mailer.render_async(
+            'self_reference_template.html',
+            name='Joe'
+        )
+        self.assertEqual(content, mailer.render('self_reference_template.html', name='Joe'))
+
+    async def test_send_email_async(self):
+        engine = Mock(spec=templatemail.engines.AsyncEngine)
+        engine.send_simple_message = AsyncMock()
+        mailer = templatemail.TemplateMail(template_dirs=[_test_template_dir], delivery_engine=engine)
+        await mailer.send_email_async(
+            to_addresses=['test@example.com'],
+            from_address='from@example.com',
+            template_name='simple_template.html'
+        )
+        engine.send_simple_message.assert_awaited_once_with(
+            from_address='from@example.com',
+            to_addresses=['test@example.com'],
+            subject='My Subject',
+            text_body='Text stuff',
+            html_body='HTML stuff',
+            headers=None
+        )
+
+    @skipUnless(aiosmtplib, 'aiosmtplib is not installed')
+    async def test_async_smtp_sending(self):
+        import templatemail.engines.async_smtp
+
+        for security in (templatemail.engines.smtp.SMTPSecurity.NONE, templatemail.engines.smtp.SMTPSecurity.START_TLS,
+                         templatemail.engines.smtp.SMTPSecurity.SSL):
+            engine = templatemail.engines.async_smtp.AsyncSMTPDeliveryEngine(
+                host='localhost',
+                port=25,
+                security=security,
+                username='test',
+                password='test'
+            )
+            with patch('templatemail.engines.async_smtp.aiosmtplib.SMTP', autospec=True) as smtp:
+                server = smtp.return_value
+                await engine.send_simple_message(from_address='from@example.com',
+                                                 to_addresses=['to@example.com'],
+                                                 subject='Test',
+                                                 text_body='TEXT Body',
+                                                 html_body='HTML Body')
+                server.login.assert_awaited_once_with('test', 'test')
+                server.sendmail.assert_awaited_once()
+                server.quit.assert_awaited_once()
+
+            with patch('templatemail.engines.async_smtp.aiosmtplib.SMTP', autospec=True) as smtp:
+                smtp.return_value.connect.side_effect = ConnectionRefusedError('Connection refused')
+                with self.assertRaises(templatemail.engines.smtp.SMTPError):
+                    await engine.send_simple_message(from_address='from@example.com',
+                                                     to_addresses=['to@example.com'],
+                                                     subject='Test',
+                                                     text_body='TEXT Body')
+
+    @skipUnless(aiohttp, 'aiohttp is not installed')
+    async def test_async_mailgun_retries_connection_errors(self):
+        import templatemail.engines.async_mailgun
+
+        engine = templatemail.engines.async_mailgun.AsyncMailgunDeliveryEngine(api_key='foobar',
+                                                                               domain_name='spam.eggs',
+                                                                               backoff_factor=0)
+        response = MagicMock()
+        response.__aenter__.return_value.status = 200
+        response.__aenter__.return_value.read = AsyncMock()
+        session = Mock()
+        session.post.side_effect = [aiohttp.ClientConnectorError(Mock(), OSError('Connection refused')), response]
+        with patch.object(engine, '_get_session', return_value=session):
+            await engine.send_simple_message(from_address='from@example.com',
+                                             to_addresses=['to@example.com'],
+                                             subject='Test',
+                                             text_body='TEXT Body')
+            self.assertEqual(session.post.call_count, 2)
+
+            # A request which may have reached Mailgun is not sent again
+            session.post.reset_mock()
+            session.post.side_effect = aiohttp.ServerDisconnectedError()
+            with self.assertRaises(aiohttp.ServerDisconnectedError):
+                await engine.send_simple_message(from_address='from@example.com',
+                                                 to_addresses=['to@example.com'],
+                                                 subject='Test',
+                                                 text_body='TEXT Body')
+            self.assertEqual(session.post.call_count, 1)